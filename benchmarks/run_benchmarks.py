@@ -0,0 +1,256 @@
+'''
+Benchmarks every stage of the distance -> catchment -> gravity -> compare pipeline on seeded synthetic networks.
+
+Run from the repository root, e.g.:
+    python benchmarks/run_benchmarks.py --zones 20 63 500 --turnstile-rows 1000000 --output results.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Allow the pipeline modules in the repository root to be imported when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import coordinate_locations as cl
+import friction_factors as ff
+import location_distances as ld
+import turnstile_data as td
+import zip_pages as zp
+from page_fetcher import PageFetcher, serve_directory
+from synthetic import make_stations, make_zips, write_turnstile_csv, write_zip_pages
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Saved zip-codes.com pages, laid out as on the site, and the values get_zip_coords should scrape from them (zip codes
+# without population are left out)
+FIXTURE_SITE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'site')
+FIXTURE_ZIPS = {'02108': (4021, 42.357603, -71.068432),
+                '02109': (3771, 42.363956, -71.053040),
+                '02110': (1733, 42.357636, -71.051417)}
+
+def measure(func, repeat=3):
+    '''
+    Times a function and measures its peak Python memory allocation.
+    Args:
+        func: a function taking no arguments
+        repeat: the number of timed runs (the fastest is reported)
+    Returns:
+        result: the return value of the last run
+        seconds: the fastest wall time in seconds
+        peak_bytes: the peak memory allocated during a separate traced run
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    # Trace memory in a separate run, since tracemalloc slows allocation-heavy code down
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+def bench_network(zones, repeat, seed):
+    '''
+    Benchmarks the distance, catchment and gravity stages on a synthetic network with the given number of stations and
+    zip codes.
+    '''
+    station_lat, station_lon = make_stations(zones, seed)
+    zip_pop, zip_lat, zip_lon = make_zips(zones, seed)
+    stations = list(station_lat)
+    records = []
+
+    def record(stage, func, **sizes):
+        result, seconds, peak = measure(func, repeat)
+        records.append(dict(stage=stage, zones=zones, seconds=seconds, peak_bytes=peak, **sizes))
+        return result
+
+    station_distances = record('station_dist_matrix', lambda: ld.station_dist_matrix(stations, station_lat, station_lon))
+    record('station_dist_matrix_haversine', lambda: ld.station_dist_matrix(stations, station_lat, station_lon, metric='haversine'))
+    zip_distances = record('zip_station_matrix', lambda: ld.zip_station_matrix(zip_lat, zip_lon, station_lat, station_lon))
+    record('zip_closest_stations', lambda: ld.zip_closest_stations(zip_distances))
+    zip_closest_station, _ = record('nearest_stations', lambda: ld.nearest_stations(zip_lat, zip_lon, station_lat, station_lon))
+    unique_stations, station_popularity, total_pop = record('station_popularities',
+                                                            lambda: ld.station_popularities(zip_closest_station, zip_pop))
+
+    # Give every catchment station synthetic turnstile totals proportional to its population
+    totals = {'entries': [station_popularity[s] * 3 for s in unique_stations],
+              'exits': [station_popularity[s] * 2 for s in unique_stations]}
+    turnstile_totals = pd.DataFrame(totals, index=unique_stations)
+
+    estimates = record('compute_factor_estimates',
+                       lambda: ff.compute_factor_estimates(unique_stations, station_popularity, station_distances, total_pop),
+                       cells=len(unique_stations) ** 2)
+    actuals = record('compute_factor_actuals',
+                     lambda: ff.compute_factor_actuals_from_totals(turnstile_totals, unique_stations, station_distances),
+                     cells=len(unique_stations) ** 2)
+    record('compare_factors', lambda: ff.compare_factors(estimates, actuals, unique_stations), cells=len(unique_stations) ** 2)
+    return records
+
+def bench_turnstile(rows, stations, repeat, seed, directory):
+    '''
+    Benchmarks streaming ingest of a synthetic turnstile data file with the given number of rows.
+    '''
+    station_lat, _ = make_stations(stations, seed)
+    names = list(station_lat)
+    path = os.path.join(directory, 'turnstile_' + str(rows) + '.csv')
+    write_turnstile_csv(path, names, rows, seed)
+    keep = names[:max(1, len(names) // 3)]
+
+    records = []
+    for stage, func in [('read_turnstile_totals', lambda: td.read_turnstile_totals(path, keep)),
+                        ('read_turnstile_buckets', lambda: td.read_turnstile_buckets(path, 'peak', keep))]:
+        _, seconds, peak = measure(func, repeat)
+        records.append({'stage': stage, 'rows': rows, 'seconds': seconds, 'peak_bytes': peak})
+    os.remove(path)
+    return records
+
+def bench_zip_pages(pages, repeat, seed, directory):
+    '''
+    Benchmarks offline ingest of a directory of synthetic zip code pages, and checks that every page (including those
+    with nested tables and unclosed rows) was parsed to the values it was written with.
+    '''
+    page_dir = os.path.join(directory, 'zip_pages_' + str(pages))
+    os.makedirs(page_dir)
+    zip_pop, zip_lat, zip_lon = write_zip_pages(page_dir, pages, seed)
+    table, seconds, peak = measure(lambda: zp.ingest_zip_pages(page_dir, None, processes=1), repeat)
+    parsed = table.set_index('zip')
+    wrong = [z for z in zip_pop if z not in parsed.index or parsed.at[z, 'population'] != zip_pop[z]
+             or parsed.at[z, 'lat'] != zip_lat[z] or parsed.at[z, 'lon'] != zip_lon[z]]
+    if wrong:
+        raise RuntimeError('Zip code pages parsed incorrectly: ' + ', '.join(wrong[:10]))
+    return [{'stage': 'ingest_zip_pages', 'rows': pages, 'seconds': seconds, 'peak_bytes': peak}]
+
+def bench_scrape(repeat, directory):
+    '''
+    Benchmarks a warm scrape of the saved fixture pages served over HTTP by page_fetcher.serve_directory, and checks that
+    the scrape returns the fixture values, that a warm run makes no network calls, and that a zip code page the server
+    does not have (status 404) stops the scrape.
+    '''
+    cache_dir = os.path.join(directory, 'page_cache')
+    expected = ({z: pop for z, (pop, _, _) in FIXTURE_ZIPS.items()}, {z: lat for z, (_, lat, _) in FIXTURE_ZIPS.items()},
+                {z: lon for z, (_, _, lon) in FIXTURE_ZIPS.items()})
+    server, base_url = serve_directory(FIXTURE_SITE)
+    try:
+        with PageFetcher(cache_dir=cache_dir) as fetcher:
+            if cl.get_zip_coords(base_url, fetcher) != expected:
+                raise RuntimeError('Fixture pages scraped incorrectly')
+        # Every page is now cached, so later runs must not touch the server
+        with PageFetcher(cache_dir=cache_dir) as fetcher:
+            _, seconds, peak = measure(lambda: cl.get_zip_coords(base_url, fetcher), repeat)
+            if fetcher.network_calls != 0:
+                raise RuntimeError('Warm scrape made ' + str(fetcher.network_calls) + ' network calls')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Serve a copy of the site without one of its zip code pages
+    site = os.path.join(directory, 'site_missing_page')
+    shutil.copytree(FIXTURE_SITE, site)
+    shutil.rmtree(os.path.join(site, 'zip-code', '02109'))
+    server, base_url = serve_directory(site)
+    try:
+        with PageFetcher(cache_dir=None, retries=0) as fetcher:
+            cl.get_zip_coords(base_url, fetcher)
+        raise RuntimeError('A missing zip code page was not detected')
+    except SystemExit as error:
+        # The page must be rejected for its status, not for the coordinates missing from the server's error page
+        if 'page not found for zip code 02109' not in str(error):
+            raise RuntimeError('Unexpected scrape error: ' + str(error))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return [{'stage': 'get_zip_coords_warm', 'rows': len(FIXTURE_ZIPS), 'seconds': seconds, 'peak_bytes': peak}]
+
+def _key(record):
+    return (record['stage'], record.get('zones'), record.get('rows'))
+
+def compare_to_baseline(records, baseline, threshold, min_seconds=0.0):
+    '''
+    Compares benchmark results with a stored baseline.
+    Args:
+        records: a list of benchmark result dictionaries
+        baseline: a list of benchmark result dictionaries from an earlier run
+        threshold: the ratio of current to baseline time above which a stage counts as a regression
+        min_seconds: stages faster than this are never reported, since their timings are dominated by noise
+    Returns:
+        regressions: a list of (record, baseline record, ratio) tuples for every stage that got slower than threshold
+    '''
+    reference = {_key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        base = reference.get(_key(record))
+        if base is None or base['seconds'] <= 0 or record['seconds'] < min_seconds:
+            continue
+        ratio = record['seconds'] / base['seconds']
+        if ratio > threshold:
+            regressions.append((record, base, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the friction factor pipeline on synthetic data.')
+    parser.add_argument('--zones', type=int, nargs='*', default=[20, 63, 500],
+                        help='network sizes (stations and zip codes) to benchmark, e.g. 20 63 500 5000')
+    parser.add_argument('--turnstile-rows', type=int, nargs='*', default=[1000000],
+                        help='turnstile file sizes in rows to benchmark, e.g. 1000000 50000000')
+    parser.add_argument('--turnstile-stations', type=int, default=63, help='number of stations in the turnstile files')
+    parser.add_argument('--zip-pages', type=int, nargs='*', default=[1000],
+                        help='numbers of saved zip code pages to benchmark ingesting, e.g. 1000 30000')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per stage')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data generator')
+    parser.add_argument('--output', help='write results as JSON to this path')
+    parser.add_argument('--baseline', help='compare results with this baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='ratio of current to baseline time that counts as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.005,
+                        help='ignore regressions in stages faster than this many seconds')
+    args = parser.parse_args(argv)
+
+    records = []
+    for zones in args.zones:
+        records.extend(bench_network(zones, args.repeat, args.seed))
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.turnstile_rows:
+            records.extend(bench_turnstile(rows, args.turnstile_stations, args.repeat, args.seed, directory))
+        for pages in args.zip_pages:
+            records.extend(bench_zip_pages(pages, args.repeat, args.seed, directory))
+        records.extend(bench_scrape(args.repeat, directory))
+
+    for record in records:
+        size = 'zones=' + str(record['zones']) if 'zones' in record else 'rows=' + str(record['rows'])
+        print('%-32s %-14s %10.4f s %10.1f MiB' % (record['stage'], size, record['seconds'], record['peak_bytes'] / 2 ** 20))
+
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'results': records}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare_to_baseline(records, baseline, args.threshold, args.min_seconds)
+        for record, base, ratio in regressions:
+            print('REGRESSION: %s %s is %.2fx slower than baseline (%.4f s vs %.4f s)'
+                  % (record['stage'], _key(record)[1:], ratio, record['seconds'], base['seconds']))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
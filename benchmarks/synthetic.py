@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+# Bounding box (latitude, longitude) of the synthetic network, roughly Greater Boston
+LAT_RANGE = (42.20, 42.45)
+LON_RANGE = (-71.26, -70.99)
+
+def make_stations(n, seed=0):
+    '''
+    Generates a synthetic set of stations with random coordinates.
+    Args:
+        n: the number of stations
+        seed: the seed of the random number generator
+    Returns:
+        station_lat: a dictionary with station keys and latitude coordinate values
+        station_lon: a dictionary with station keys and longitude coordinate values
+    '''
+    rng = np.random.default_rng(seed)
+    names = ['Station ' + str(i) for i in range(n)]
+    lat = rng.uniform(*LAT_RANGE, size=n)
+    lon = rng.uniform(*LON_RANGE, size=n)
+    return dict(zip(names, lat.tolist())), dict(zip(names, lon.tolist()))
+
+def make_zips(n, seed=0):
+    '''
+    Generates a synthetic set of zip code neighborhoods with random coordinates and populations.
+    Args:
+        n: the number of zip codes
+        seed: the seed of the random number generator
+    Returns:
+        zip_pop: a dictionary with zip code keys and population values
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+    '''
+    rng = np.random.default_rng(seed + 1)
+    zips = [str(10000 + i).zfill(5) for i in range(n)]
+    pop = rng.integers(1000, 60000, size=n)
+    lat = rng.uniform(*LAT_RANGE, size=n)
+    lon = rng.uniform(*LON_RANGE, size=n)
+    return dict(zip(zips, pop.tolist())), dict(zip(zips, lat.tolist())), dict(zip(zips, lon.tolist()))
+
+def write_turnstile_csv(path, stations, rows, seed=0, start='2013-01-01', chunk_rows=1000000):
+    '''
+    Writes a synthetic turnstile data CSV file in the same layout as turnstile_data.csv, in chunks so that files of tens
+    of millions of rows can be generated with flat memory use. Observations are 15 minutes apart per station, so large
+    files span several years.
+    Args:
+        path: the path of the CSV file to write
+        stations: a list of station names
+        rows: the total number of rows to write
+        seed: the seed of the random number generator
+        start: the timestamp of the first observation
+        chunk_rows: the number of rows generated at a time
+    '''
+    rng = np.random.default_rng(seed + 2)
+    stations = np.asarray(stations, dtype=object)
+    # Busier stations have proportionally more entries and exits
+    scale = rng.uniform(20, 400, size=len(stations))
+    start = pd.Timestamp(start)
+    with open(path, 'w', newline='') as f:
+        f.write('time,station,entries,exits\n')
+        for offset in range(0, rows, chunk_rows):
+            n = min(chunk_rows, rows - offset)
+            row = np.arange(offset, offset + n)
+            station = row % len(stations)
+            times = start + pd.to_timedelta((row // len(stations)) * 15, unit='min')
+            chunk = pd.DataFrame({'time': times.strftime('%Y-%m-%d %H:%M:%S'),
+                                  'station': stations[station],
+                                  'entries': rng.poisson(scale[station]),
+                                  'exits': rng.poisson(scale[station])})
+            chunk.to_csv(f, header=False, index=False)
+
+# Layouts of the label rows of a synthetic zip code page: plain rows, rows that open a table nested inside a cell, and
+# rows left open (no </tr> or </td>) until the next row starts
+ZIP_PAGE_LAYOUTS = ('plain', 'nested', 'unclosed')
+
+def _zip_page(zip_code, pop, lat, lon, layout, filler_rows):
+    filler = ''.join('<tr><td class="label">Field %d:</td><td>value &amp; more</td></tr>' % i for i in range(filler_rows))
+    rows = [('Latitude:', '%.6f' % lat), ('Longitude:', '%.6f' % lon), ('Current Population:', format(pop, ','))]
+    if layout == 'plain':
+        labels = ''.join('<tr><td class="info"><a href="#">%s</a></td><td class="info">%s</td></tr>' % row for row in rows)
+    elif layout == 'nested':
+        # The label rows are the first rows of a table inside a cell of the enclosing row
+        labels = ('<tr><td>Location <table>' + ''.join('<tr><td>%s</td><td>%s</td></tr>' % row for row in rows)
+                  + '</table></td><td>see above</td></tr>')
+    else:
+        labels = ''.join('<tr><td>%s<td>%s' % row for row in rows)
+    return ('<html><head><title>ZIP Code %s</title></head><body><table>%s%s</table></body></html>'
+            % (zip_code, filler, labels))
+
+def write_zip_pages(directory, n, seed=0):
+    '''
+    Writes synthetic zip-codes.com zip code pages (zip-code-<zip>.asp), cycling through ZIP_PAGE_LAYOUTS and varying the
+    number of rows before the labelled ones, so that parsers cannot rely on row positions.
+    Args:
+        directory: the directory to write the pages to
+        n: the number of pages
+        seed: the seed of the random number generator
+    Returns:
+        zip_pop: a dictionary with zip code keys and population values
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+    '''
+    zip_pop, zip_lat, zip_lon = make_zips(n, seed)
+    rng = np.random.default_rng(seed + 3)
+    for i, zip_code in enumerate(zip_pop):
+        page = _zip_page(zip_code, zip_pop[zip_code], zip_lat[zip_code], zip_lon[zip_code],
+                         ZIP_PAGE_LAYOUTS[i % len(ZIP_PAGE_LAYOUTS)], int(rng.integers(8, 16)))
+        with open(f'{directory}/zip-code-{zip_code}.asp', 'w') as f:
+            f.write(page)
+    # Coordinates are written with 6 decimals
+    return zip_pop, {z: round(v, 6) for z, v in zip_lat.items()}, {z: round(v, 6) for z, v in zip_lon.items()}
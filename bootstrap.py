@@ -0,0 +1,66 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import friction_factors as ff
+
+def _block_arrays(block_totals, stations):
+    # Lay entries and exits out as (block, station) arrays, with zero for stations that saw no traffic in a block
+    entries = block_totals['entries'].unstack('station', fill_value=0).reindex(columns=stations, fill_value=0)
+    exits = block_totals['exits'].unstack('station', fill_value=0).reindex(index=entries.index, columns=stations, fill_value=0)
+    return entries.to_numpy(dtype=np.float64), exits.to_numpy(dtype=np.float64)
+
+def _bootstrap_batch(entries, exits, distances, replicates, seed):
+    '''
+    Computes the friction factor matrices of a batch of bootstrap replicates in one vectorized operation.
+    '''
+    rng = np.random.default_rng(seed)
+    n_blocks = entries.shape[0]
+    # Resampling blocks with replacement is the same as weighting each block by how many times it was drawn
+    weights = rng.multinomial(n_blocks, np.full(n_blocks, 1.0 / n_blocks), size=replicates).astype(np.float64)
+    sampled_entries = weights @ entries
+    sampled_exits = weights @ exits
+    return ff.gravity_kernel(sampled_entries, sampled_exits, distances, sampled_exits.sum(axis=1))
+
+def bootstrap_factor_actuals(block_totals, unique_stations, station_distances, replicates=1000, percentiles=(2.5, 97.5),
+                             batch_size=100, processes=1, seed=None):
+    '''
+    Estimates the uncertainty of the actual friction factors by resampling turnstile days (or weeks) with replacement and
+    recomputing the friction factor matrix for every replicate. Replicates are computed in vectorized batches, which can
+    be spread over several processes; results only depend on seed and batch_size, not on the number of processes.
+    Args:
+        block_totals: a dataframe indexed by (station, bucket), with total 'entries' and 'exits' columns, as produced by
+        turnstile_data.read_turnstile_buckets with bucket='day' or bucket='week'
+        unique_stations: an array consisting of all the unique MBTA stations for which data was scraped
+        station_distances: a pandas dataframe/matrix indicating the distances between MBTA stations
+        replicates: the number of bootstrap replicates
+        percentiles: the lower and upper percentiles of the interval to report
+        batch_size: the number of replicates computed together in one vectorized batch
+        processes: the number of worker processes (1 computes every batch in the current process)
+        seed: the seed of the random number generator
+    Returns:
+        friction_actuals: a pandas dataframe/matrix holding the friction factors computed from all of the turnstile data
+        lower: a pandas dataframe/matrix holding the lower percentile of each friction factor over the replicates
+        upper: a pandas dataframe/matrix holding the upper percentile of each friction factor over the replicates
+    '''
+    stations = list(unique_stations)
+    entries, exits = _block_arrays(block_totals, stations)
+    distances = station_distances.loc[stations, stations].to_numpy(dtype=np.float64)
+
+    # Independent random streams per batch keep results reproducible however the batches are scheduled
+    sizes = [min(batch_size, replicates - start) for start in range(0, replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if processes == 1 or len(sizes) == 1:
+        batches = [_bootstrap_batch(entries, exits, distances, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            batches = list(executor.map(_bootstrap_batch, [entries] * len(sizes), [exits] * len(sizes),
+                                        [distances] * len(sizes), sizes, seeds))
+    samples = np.concatenate(batches, axis=0)
+
+    lower, upper = np.percentile(samples, percentiles, axis=0)
+    point = ff.gravity_kernel(entries.sum(axis=0), exits.sum(axis=0), distances, exits.sum())
+    return (pd.DataFrame(point, index=stations, columns=stations),
+            pd.DataFrame(lower, index=stations, columns=stations),
+            pd.DataFrame(upper, index=stations, columns=stations))
@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+
+def deterrence(distances, beta, decay='power'):
+    '''
+    Evaluates a distance-decay (deterrence) function for every pair of zones. Pairs with zero distance (the diagonal)
+    get zero deterrence, so that no intrazonal trips are modelled.
+    Args:
+        distances: an array of shape (n, n) holding the distances between zones
+        beta: the decay parameter
+        decay: 'power' for distance ** -beta, or 'exponential' for exp(-beta * distance)
+    Returns:
+        friction: a float64 numpy array of shape (n, n) holding the deterrence between every pair of zones
+    '''
+    distances = np.asarray(distances, dtype=np.float64)
+    positive = distances > 0
+    friction = np.zeros_like(distances)
+    if decay == 'power':
+        np.power(distances, -beta, out=friction, where=positive)
+    elif decay == 'exponential':
+        np.exp(-beta * distances, out=friction, where=positive)
+    else:
+        raise ValueError('Unknown decay function: ' + str(decay))
+    return friction
+
+def _safe_reciprocal(values):
+    return np.divide(1.0, values, out=np.zeros_like(values), where=values > 0)
+
+def furness(productions, attractions, friction, tol=1e-6, max_iter=1000, col_factors=None):
+    '''
+    Fits the balancing factors of a doubly-constrained gravity model T(i,j) = a(i) O(i) b(j) D(j) f(i,j) by iterative
+    proportional fitting (the Furness method), so that modelled trips leaving each zone match productions O and modelled
+    trips arriving at each zone match attractions D.
+    Args:
+        productions: an array of the observed trips leaving each zone (e.g. turnstile entries)
+        attractions: an array of the observed trips arriving at each zone (e.g. turnstile exits), rescaled to the total
+        of productions if the two totals differ
+        friction: an array of shape (n, n) holding the deterrence between every pair of zones (see deterrence)
+        tol: the largest relative error in modelled trips leaving a zone at which to stop iterating
+        max_iter: the maximum number of iterations
+        col_factors: balancing factors b from a previous solution to warm-start from (ones if None)
+    Returns:
+        trips: a float64 numpy array of shape (n, n) holding the modelled trips from zone i to zone j
+        row_factors: the balancing factors a
+        col_factors: the balancing factors b, which can be passed back in to warm-start a related fit
+        iterations: the number of iterations run
+        converged: whether the tolerance was reached within max_iter iterations
+    '''
+    productions = np.asarray(productions, dtype=np.float64)
+    attractions = np.asarray(attractions, dtype=np.float64)
+    friction = np.asarray(friction, dtype=np.float64)
+    # Both trip ends must sum to the same total for the constraints to be consistent
+    if attractions.sum() > 0:
+        attractions = attractions * (productions.sum() / attractions.sum())
+
+    b = np.ones_like(attractions) if col_factors is None else np.asarray(col_factors, dtype=np.float64).copy()
+    active = productions > 0
+    pulled = friction @ (b * attractions)
+    iterations = 0
+    converged = False
+    while iterations < max_iter:
+        iterations += 1
+        # Balance rows, then columns; the column constraints hold exactly after every iteration
+        a = _safe_reciprocal(pulled)
+        b = _safe_reciprocal(friction.T @ (a * productions))
+        pulled = friction @ (b * attractions)
+        # Ratio of modelled to observed trips leaving each zone
+        error = np.abs(a[active] * pulled[active] - 1.0)
+        if error.size == 0 or error.max() < tol:
+            converged = True
+            break
+
+    trips = (a * productions)[:, None] * friction * (b * attractions)[None, :]
+    return trips, a, b, iterations, converged
+
+def mean_trip_cost(trips, distances):
+    '''
+    Computes the average distance (cost) of the modelled trips.
+    Args:
+        trips: an array of shape (n, n) holding trips from zone i to zone j
+        distances: an array of shape (n, n) holding the distances between zones
+    Returns:
+        cost: the trip-weighted mean distance, or zero if there are no trips
+    '''
+    total = trips.sum()
+    return float((trips * distances).sum() / total) if total > 0 else 0.0
+
+def calibrate(productions, attractions, distances, target_cost, beta=1.0, decay='power', tol=1e-6, max_iter=1000,
+              cost_tol=1e-4, max_beta_iter=50, col_factors=None):
+    '''
+    Calibrates the distance-decay parameter beta of a doubly-constrained gravity model so that the modelled mean trip
+    distance matches an observed one (Hyman's method), fitting the balancing factors by the Furness method at every step.
+    Each Furness fit is warm-started from the balancing factors of the previous one.
+    Args:
+        productions: an array of the observed trips leaving each zone (e.g. turnstile entries)
+        attractions: an array of the observed trips arriving at each zone (e.g. turnstile exits)
+        distances: an array of shape (n, n) holding the distances between zones
+        target_cost: the observed mean trip distance, in the units of distances
+        beta: the starting value of beta, e.g. the result of a previous calibration
+        decay: 'power' or 'exponential' (see deterrence)
+        tol: the Furness tolerance (see furness)
+        max_iter: the maximum number of Furness iterations per value of beta
+        cost_tol: the relative error in mean trip distance at which to stop updating beta
+        max_beta_iter: the maximum number of values of beta to try
+        col_factors: balancing factors from a previous solution to warm-start from
+    Returns:
+        beta: the calibrated decay parameter, i.e. the one that produced trips (the last one with a finite fit if
+        calibration did not converge)
+        trips: a float64 numpy array of shape (n, n) holding the modelled trips from zone i to zone j
+        row_factors: the balancing factors a
+        col_factors: the balancing factors b
+        converged: whether both beta and the final Furness fit converged
+    '''
+    distances = np.asarray(distances, dtype=np.float64)
+    target_cost = float(target_cost)
+    if not beta > 0:
+        raise ValueError('The starting value of beta must be positive: ' + str(beta))
+
+    # Mean trip cost falls as beta grows, so every fit narrows the bracket (lower, upper) that holds the calibrated beta
+    lower, upper = 0.0, np.inf
+    previous = fit = None
+    for _ in range(max_beta_iter):
+        # A target out of reach drives beta to where the deterrence overflows (or underflows to no trips at all); such
+        # fits are detected below rather than warned about
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore', under='ignore'):
+            trips, a, b, _, furness_converged = furness(productions, attractions, deterrence(distances, beta, decay),
+                                                        tol, max_iter, col_factors)
+            cost = mean_trip_cost(trips, distances)
+        if not (np.isfinite(cost) and np.isfinite(trips).all() and trips.sum() > 0):
+            break
+        previous, fit = fit, (beta, trips, a, b, cost)
+        col_factors = b
+        if abs(cost - target_cost) <= cost_tol * target_cost:
+            return beta, trips, a, b, furness_converged
+        if previous is not None and abs(cost - previous[4]) <= cost_tol * target_cost:
+            # The mean trip cost no longer changes with beta, so the target cannot be reached
+            break
+
+        if cost > target_cost:
+            lower = beta
+        else:
+            upper = beta
+        if previous is None:
+            # First step: scale beta by the ratio of modelled to target cost (a larger beta shortens trips)
+            next_beta = beta * cost / target_cost
+        else:
+            # Secant step on mean trip cost as a function of beta
+            next_beta = beta + (target_cost - cost) * (beta - previous[0]) / (cost - previous[4])
+        if not lower < next_beta < upper:
+            # Steps leaving the bracket (or not finite) are replaced by bisection, or by doubling beta until the target
+            # is first overshot
+            next_beta = 2.0 * beta if upper == np.inf else 0.5 * (lower + upper)
+        beta = next_beta
+
+    if fit is None:
+        # Not even the starting beta gave a finite fit
+        return beta, trips, a, b, False
+    # Return the last finite fit, with the beta that produced it
+    beta, trips, a, b, _ = fit
+    return beta, trips, a, b, False
+
+def calibrate_friction_factors(turnstile_totals, unique_stations, station_distances, target_cost, beta=1.0, decay='power',
+                               **options):
+    '''
+    Calibrates friction factors between MBTA stations so that a doubly-constrained gravity model reproduces the observed
+    turnstile entries and exits and an observed mean trip distance.
+    Args:
+        turnstile_totals: a dataframe indexed by station, with total 'entries' and 'exits' columns
+        unique_stations: an array consisting of all the unique MBTA stations to include
+        station_distances: a pandas dataframe/matrix indicating the distances between MBTA stations
+        target_cost: the observed mean trip distance, in the units of station_distances
+        beta: the starting value of the decay parameter
+        decay: 'power' or 'exponential' (see deterrence)
+        options: further keyword arguments passed on to calibrate
+    Returns:
+        friction_factors: a pandas dataframe/matrix holding the calibrated deterrence between MBTA stations
+        trips: a pandas dataframe/matrix holding the modelled trips from station i to station j
+        beta: the calibrated decay parameter, which produced trips
+        converged: whether calibration converged (if not, trips and friction_factors do not match target_cost)
+    '''
+    stations = list(unique_stations)
+    entries = turnstile_totals.loc[stations, 'entries'].to_numpy(dtype=np.float64)
+    exits = turnstile_totals.loc[stations, 'exits'].to_numpy(dtype=np.float64)
+    distances = station_distances.loc[stations, stations].to_numpy(dtype=np.float64)
+
+    beta, trips, _, _, converged = calibrate(entries, exits, distances, target_cost, beta, decay, **options)
+    friction = deterrence(distances, beta, decay)
+    return (pd.DataFrame(friction, index=stations, columns=stations),
+            pd.DataFrame(trips, index=stations, columns=stations),
+            beta, converged)
@@ -1,17 +1,29 @@
+import argparse
+import os
 import coordinate_locations as cl
 import friction_factors as ff
 import location_distances as ld
+import matrix_store as ms
+import render_heatmaps as rh
+import turnstile_data as td
+from instrumentation import RunReport
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
 
-def visualize_results(friction_factor_comparison):
+def visualize_results(friction_factor_comparison, output_path=None, order=None):
     '''
     Displays a heatmap of friction factor comparisons between actual factors and estimated factors.
     Args:
         friction_factor_comparison: a pandas dataframe, in which each entry represents the friction factor between two MBTA stations
+        output_path: if given, the heatmap is written to this image file without a display instead of being shown
+        order: the order of the stations in a written heatmap: None, 'line' or 'cluster' (see render_heatmaps.reduce_matrix)
     '''    
+    if output_path is not None:
+        # Render headlessly, averaging large matrices down so that render time and file size stay bounded
+        rh.render_heatmap(friction_factor_comparison, output_path, order=order, groups=cl.STATION_LINES)
+        return
     # Visualize comparison of actual to estimated friction factors as a heatmap
     # Fill NAs (the only cell this line of code modifies is the top left corner cell, which is considered to be NA by pandas because it is blank)
     friction_factor_comparison.fillna(value=np.nan, inplace=True)
@@ -24,37 +36,123 @@ def visualize_results(friction_factor_comparison):
     ax.set_title('MBTA Station Friction Factors: Comparison')
     plt.show()
 
-if __name__ == '__main__':
-    # Read in turnstile data
-    # Data from https://github.com/mbtaviz/mbtaviz.github.io/
-    turnstile_df = pd.read_csv('./data/turnstile_data.csv')
-    # Get all unique MBTA station names for which we have turnstile data
-    stations = turnstile_df.station.unique()
+# Names of the stages of main, which can be profiled with --profile-stage
+STAGES = ('scrape_zips', 'station_coords', 'catchment', 'popularity', 'distances', 'turnstile', 'estimates', 'actuals',
+          'compare', 'export_csv')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare gravity model friction factor estimates with MBTA turnstile data.')
+    parser.add_argument('--report', help='write a JSON report of per-stage wall time, CPU time, memory and counts to this path')
+    parser.add_argument('--profile-stage', choices=STAGES, help='run the named stage under cProfile (works with or without --report)')
+    parser.add_argument('--profile-output', help='file to dump the cProfile statistics to (default: <stage>.prof)')
+    parser.add_argument('--output-dir', default='./friction_factors', help='directory to save the friction factor matrices to')
+    parser.add_argument('--csv', action='store_true', help='also export the friction factor matrices as CSV files')
+    parser.add_argument('--radius', type=float, help='only compare station pairs within this distance (in coordinate degrees), using sparse matrices')
+    parser.add_argument('--neighbours', type=int, help="only compare each station with its k nearest stations, using sparse matrices")
+    parser.add_argument('--zip-table', help='load zip codes from a table written by zip_pages.py instead of scraping them')
+    parser.add_argument('--heatmap', help='write the comparison heatmap to this image file instead of showing it')
+    parser.add_argument('--order', choices=['line', 'cluster'], help='order the stations of the written heatmap by line or by clustering')
+    args = parser.parse_args(argv)
+    # Profiling a stage does not need a report, but only a report traces memory
+    report = RunReport(enabled=args.report is not None or args.profile_stage is not None, trace_memory=args.report is not None,
+                       profile_stage=args.profile_stage, profile_path=args.profile_output)
+
+    with report.stage('scrape_zips') as counts:
+        # Get latitude, longitude coordinates and populations for each zip code
+        zip_pop, zip_lat, zip_lon = cl.get_zip_coords(table_path=args.zip_table)
+        zips = list(zip_pop)
+        counts['zips'] = len(zips)
+    with report.stage('station_coords') as counts:
+        # Get the registry of MBTA stations, which assigns each station an integer ID and holds its coordinates
+        registry = cl.get_station_registry()
+        counts['stations'] = len(registry)
     
-    # Get latitude, longitude coordinates and populations for each zip code
-    zip_pop, zip_lat, zip_lon = cl.get_zip_coords()
-    # Get latitude, longitude coordinations for each MBTA station
-    station_lat, station_lon = cl.get_station_coords()
+    with report.stage('catchment') as counts:
+        # Determine the ID of the closest MBTA station to each zip code neighborhood
+        zip_station_ids, _ = ld.nearest_station_ids(registry, [zip_lat[z] for z in zips], [zip_lon[z] for z in zips])
+        counts['zips'] = len(zip_station_ids)
+    with report.stage('popularity') as counts:
+        # Sum the populations of the zip code neighborhoods closest to each station
+        popularity = ld.station_popularity_array(registry, zip_station_ids, [zip_pop[z] for z in zips])
+        # Only stations with a nonzero catchment population take part in the comparison
+        station_ids = np.flatnonzero(popularity > 0)
+        unique_stations = registry.labels(station_ids)
+        total_pop = popularity.sum()
+        counts['stations'] = len(station_ids)
+    # Sparse mode keeps only nearby pairs of stations, so memory scales with stations * neighbours rather than stations^2
+    sparse_mode = args.radius is not None or args.neighbours is not None
+    kernel = ff.sparse_gravity_kernel if sparse_mode else ff.gravity_kernel
+    save = ms.save_sparse_matrix if sparse_mode else ms.save_matrix
+    labels = [unique_stations, unique_stations]
+
+    with report.stage('distances') as counts:
+        # Get the distances (in Euclidean coordinate metrics) between the MBTA stations we have population data for
+        if sparse_mode:
+            station_distances = ld.registry_sparse_dist_matrix(registry, station_ids, args.radius, args.neighbours)
+            counts['cells'] = station_distances.nnz
+        else:
+            station_distances = ld.registry_dist_matrix(registry, station_ids)
+            counts['cells'] = station_distances.size
     
-    # Get the distances (in Euclidean coordinate metrics) between all MBTA stations
-    station_distances = ld.station_dist_matrix(stations, station_lat, station_lon)
-    # Determine the closest MBTA station to each zip code neighborhood
-    zip_closest_station = ld.zip_closest_stations(ld.zip_station_matrix(zip_lat, zip_lon, station_lat, station_lon))
-    # Format information that we already have into a dictionary with station keys and corresponding populations as values
-    unique_stations, station_popularity, total_pop = ld.station_popularities(zip_closest_station, zip_pop)
+    with report.stage('turnstile') as counts:
+        # Stream the turnstile data, keeping only the stations we have population data for
+        # Per-file aggregates are cached, so only new or changed turnstile files are read
+        # Data from https://github.com/mbtaviz/mbtaviz.github.io/
+        turnstile_totals = td.cached_turnstile_totals(td.TURNSTILE_DIR, unique_stations)
+        entries, exits = td.station_arrays(turnstile_totals, registry)
+        counts['rows'] = len(turnstile_totals)
+    # Ensure the station names of both data sources are identical
+    assert sorted(turnstile_totals.index) == sorted(unique_stations)
     
-    # Get friction factors according to the gravity model
-    friction_factor_estimates = ff.compute_factor_estimates(unique_stations, station_popularity, station_distances, total_pop)
-    # Save friction factors to CSV file for easy reference
-    friction_factor_estimates.to_csv('./friction_factors/estimated_factors.csv')
+    with report.stage('estimates') as counts:
+        # Get friction factors according to the gravity model
+        estimates = kernel(popularity[station_ids], popularity[station_ids], station_distances, total_pop)
+        # Save friction factors as a binary matrix (memory-mappable when dense), labelled by station
+        save(os.path.join(args.output_dir, 'estimated_factors'), estimates, labels)
+        counts['cells'] = estimates.nnz if sparse_mode else estimates.size
     
-    # Get friction factors based on actual turnstile data
-    friction_factor_actuals = ff.compute_factor_actuals(turnstile_df, unique_stations, station_distances)
-    # Save friction factors to CSV file for easy reference
-    friction_factor_estimates.to_csv('./friction_factors/actual_factors.csv')
+    with report.stage('actuals') as counts:
+        # Get friction factors based on actual turnstile data
+        actuals = kernel(entries[station_ids], exits[station_ids], station_distances, exits[station_ids].sum())
+        # Save friction factors as a binary matrix (memory-mappable when dense), labelled by station
+        save(os.path.join(args.output_dir, 'actual_factors'), actuals, labels)
+        counts['cells'] = actuals.nnz if sparse_mode else actuals.size
     
-    # Generate a dataframe that displays a comparison (in ratios) of actual versus estimated friction factors
-    friction_factor_comparison = ff.compare_factors(friction_factor_estimates, friction_factor_actuals, unique_stations)
+    with report.stage('compare') as counts:
+        # Generate a comparison (in ratios) of actual versus estimated friction factors
+        ratios = ff.factor_ratios(estimates, actuals)
+        save(os.path.join(args.output_dir, 'factor_comparison'), ratios, labels)
+        counts['cells'] = ratios.nnz if sparse_mode else ratios.size
+
+    if args.csv:
+        with report.stage('export_csv') as counts:
+            # Stream the saved matrices to CSV files for easy reference, a block of rows at a time (sparse matrices are
+            # written in long format, one line per stored pair of stations)
+            for name in ('estimated_factors', 'actual_factors', 'factor_comparison'):
+                path = os.path.join(args.output_dir, name)
+                if sparse_mode:
+                    ms.export_sparse_csv(path, path + '.csv')
+                else:
+                    ms.export_csv(path, path + '.csv')
+            counts['files'] = 3
     
+    if args.report is not None:
+        report.write(args.report)
+    
+    if sparse_mode:
+        if len(unique_stations) > rh.MAX_SIZE:
+            print('Skipping the heatmap of ' + str(len(unique_stations)) + ' stations in sparse mode; the comparison is saved in '
+                  + args.output_dir)
+            return
+        # Pairs beyond the cutoff were not compared, so they are left blank rather than shown as zero
+        dense = np.full(ratios.shape, np.nan)
+        coo = ratios.tocoo()
+        dense[coo.row, coo.col] = coo.data
+        ratios = dense
+    friction_factor_comparison = pd.DataFrame(ratios, index=unique_stations, columns=unique_stations)
+
     # Call function that allows visualization of results using a heatmap
-    visualize_results(friction_factor_comparison)
\ No newline at end of file
+    visualize_results(friction_factor_comparison, args.heatmap, args.order)
+
+if __name__ == '__main__':
+    main()
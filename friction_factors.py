@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 def consolidate_turnstile_data(turnstile_df, unique_stations):
     '''
@@ -23,6 +25,53 @@ def consolidate_turnstile_data(turnstile_df, unique_stations):
     
     return turnstile_df
 
+def gravity_kernel(productions, attractions, distances, total):
+    '''
+    Evaluates the gravity model productions(i) * attractions(j) / total / distance(i,j) for every pair of zones at once.
+    Any leading dimensions of productions, attractions and total are treated as a batch (e.g. one matrix per time bucket).
+    Args:
+        productions: an array of trip productions per zone, of shape (..., n)
+        attractions: an array of trip attractions per zone, of shape (..., n), aligned with productions
+        distances: an array of shape (n, n) holding the distances between zones
+        total: the normalising total (a scalar, or an array broadcastable to the batch dimensions)
+    Returns:
+        factors: a float64 numpy array of shape (..., n, n) whose entry (i,j) is the friction factor between zone i and
+        zone j, and zero wherever the distance or the total is zero
+    '''
+    productions = np.asarray(productions, dtype=np.float64)
+    attractions = np.asarray(attractions, dtype=np.float64)
+    distances = np.asarray(distances, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)[..., None, None]
+
+    # Outer product of productions and attractions, normalised by the total
+    flows = productions[..., :, None] * attractions[..., None, :]
+    flows = np.divide(flows, total, out=np.zeros_like(flows), where=total > 0)
+    # Divide by distance, leaving zero on the diagonal and for any pair of coincident zones
+    return np.divide(flows, distances, out=np.zeros_like(flows), where=distances > 0)
+
+def sparse_gravity_kernel(productions, attractions, distances, total):
+    '''
+    Evaluates the gravity model productions(i) * attractions(j) / total / distance(i,j) for only the pairs of zones stored
+    in a sparse distance matrix (e.g. those within a radius of each other), in O(stored pairs) time and memory.
+    Args:
+        productions: an array of trip productions per zone, of shape (n,)
+        attractions: an array of trip attractions per zone, of shape (n,), aligned with productions
+        distances: a scipy.sparse matrix of shape (n, n), as built by location_distances.sparse_dist_matrix
+        total: the normalising total
+    Returns:
+        factors: a scipy.sparse CSR matrix with the same stored pairs as distances, holding the friction factor of each
+        (zero wherever the distance or the total is zero)
+    '''
+    productions = np.asarray(productions, dtype=np.float64)
+    attractions = np.asarray(attractions, dtype=np.float64)
+    distances = sparse.csr_matrix(distances, dtype=np.float64)
+    # Row index of every stored pair, expanded from the CSR row pointers
+    rows = np.repeat(np.arange(distances.shape[0]), np.diff(distances.indptr))
+    flows = productions[rows] * attractions[distances.indices]
+    flows = flows / total if total > 0 else np.zeros_like(flows)
+    data = np.divide(flows, distances.data, out=np.zeros_like(flows), where=distances.data > 0)
+    return sparse.csr_matrix((data, distances.indices.copy(), distances.indptr.copy()), shape=distances.shape)
+
 def compute_factor_estimates(unique_stations, station_popularity, station_distances, total_pop):
     '''
     Computes the friction factors between all MBTA stations based on populations of nearby zip code neighborhoods and distances between
@@ -37,27 +86,14 @@ def compute_factor_estimates(unique_stations, station_popularity, station_distan
         friction_estimates: a pandas dataframe/matrix holding the friction factors between all MBTA stations in the unique_stations
         array
     '''
-    # Initialize dataframe friction_estimates, with MBTA stations as both indices and column names
-    # Entry (i,j) in this matrix will represent the friction factor between station i and station j
-    # This dataframe will be of shape 20 x 20
-    friction_estimates = pd.DataFrame(columns=list(unique_stations), index=list(unique_stations))
-    
-    for i in range(len(friction_estimates)): # For every row in friction_estimates dataframe
-        for j in range(len(friction_estimates)): # For every column in friction_estimates dataframe
-            # Compute the friction factor between station i and station j
-            # Compute the number of trips from station i times the attraction factor of station j
-            # We assume the attraction factor of station j is proportional to the population of station j's neighborhood divided by the total population of the sample
-            pop_product = float(station_popularity[friction_estimates.index[i]]) * float(station_popularity[friction_estimates.columns[j]]) / total_pop
-            
-            # Divide pop_product by the Euclidean coordinate distance between station i and station j
-            try:
-                fric_factor = float(pop_product) / float(station_distances.loc[friction_estimates.index[i]][friction_estimates.columns[j]])
-            except:
-                fric_factor = 0.0
-            # Enter the friction factor into the appropriate position in the dataframe
-            friction_estimates.iloc[i][j] = fric_factor
-
-    return friction_estimates
+    stations = list(unique_stations)
+    # The number of trips from station i is proportional to its population, and the attraction factor of station j
+    # is proportional to the population of station j's neighborhood divided by the total population of the sample
+    popularity = np.array([station_popularity[station] for station in stations], dtype=np.float64)
+    distances = station_distances.loc[stations, stations].to_numpy(dtype=np.float64)
+
+    factors = gravity_kernel(popularity, popularity, distances, float(total_pop))
+    return pd.DataFrame(factors, index=stations, columns=stations)
 
 def compute_factor_actuals(turnstile_df, unique_stations, station_distances):
     '''
@@ -71,28 +107,70 @@ def compute_factor_actuals(turnstile_df, unique_stations, station_distances):
     '''
     # Call function that aggregates data into a simple form
     df = consolidate_turnstile_data(turnstile_df, unique_stations)
-    
-    # Initialize dataframe friction_actuals, with MBTA stations as both indices and column names
-    # Entry (i,j) in this matrix will represent the friction factor between station i and station j
+    return compute_factor_actuals_from_totals(df, unique_stations, station_distances)
+
+def compute_factor_actuals_from_totals(turnstile_totals, unique_stations, station_distances):
+    '''
+    Computes the friction factors between all MBTA stations based on already aggregated station turnstile data (e.g. from
+    consolidate_turnstile_data or turnstile_data.read_turnstile_totals) and distances between stations.
+    Args:
+        turnstile_totals: a dataframe indexed by station, with total 'entries' and 'exits' columns
+        unique_stations: an array consisting of all the unique MBTA stations for which data was scraped
+        station_distances: a pandas dataframe/matrix indicating the Euclidean coordinate distances between MBTA stations
+    Returns:
+        friction_actuals: a pandas dataframe/matrix holding friction factors between MBTA stations based on actual turnstile data
+    '''
     # Although we have data to support a 63 x 63 matrix, we only had data for a 20 x 20 estimation matrix, so we will do the same
     # with the raw data, to yield an apples to apples comparison
-    friction_actuals = pd.DataFrame(columns=list(unique_stations), index=list(unique_stations))
-    
-    for i in range(len(friction_actuals)): # For every row i in friction_actuals dataframe
-        for j in range(len(friction_actuals)): # For every column j in friction_actuals dataframe
-            # Compute friction factor between station i and station j
-            # Compute the number of entrances from station i times the number of exits from station j, divided by total number of exits
-            enter_exit_product = float(df.loc[friction_actuals.index[i]]['entries']) * float(df.loc[friction_actuals.columns[j]]['exits']) / float(df.exits.sum())
-    
-            # Divide enter_exit_product by the distance between station i and station j
-            try:
-                fric_factor = float(enter_exit_product) / float(station_distances.loc[friction_actuals.index[i]][friction_actuals.columns[j]])
-            except:
-                fric_factor = 0.0
-            # Enter the friction factor into the appropriate position in the dataframe
-            friction_actuals.iloc[i][j] = fric_factor
-    
-    return friction_actuals
+    stations = list(unique_stations)
+    entries = turnstile_totals.loc[stations, 'entries'].to_numpy(dtype=np.float64)
+    exits = turnstile_totals.loc[stations, 'exits'].to_numpy(dtype=np.float64)
+    distances = station_distances.loc[stations, stations].to_numpy(dtype=np.float64)
+
+    # The number of entrances at station i times the number of exits at station j, divided by the total number of exits
+    factors = gravity_kernel(entries, exits, distances, exits.sum())
+    return pd.DataFrame(factors, index=stations, columns=stations)
+
+def compute_factor_tensor(bucket_totals, unique_stations, station_distances):
+    '''
+    Computes the friction factors between all MBTA stations separately for every time bucket (e.g. AM/PM peak, weekday/weekend
+    or month) in one vectorized operation, based on turnstile data aggregated by turnstile_data.read_turnstile_buckets.
+    Args:
+        bucket_totals: a dataframe indexed by (station, bucket), with total 'entries' and 'exits' columns
+        unique_stations: an array consisting of all the unique MBTA stations for which data was scraped
+        station_distances: a pandas dataframe/matrix indicating the distances between MBTA stations
+    Returns:
+        friction_tensor: a float64 numpy array of shape (stations, stations, buckets) whose entry (i,j,b) is the friction
+        factor between station i and station j in time bucket b
+        buckets: a list of the time bucket labels, in the order of the last axis of friction_tensor
+    '''
+    stations = list(unique_stations)
+    # Lay entries and exits out as (bucket, station) arrays; stations without traffic in a bucket count as zero
+    entries = bucket_totals['entries'].unstack('station', fill_value=0).reindex(columns=stations, fill_value=0)
+    exits = bucket_totals['exits'].unstack('station', fill_value=0).reindex(columns=stations, fill_value=0)
+    buckets = list(entries.index)
+    entries = entries.to_numpy(dtype=np.float64)
+    exits = exits.loc[buckets].to_numpy(dtype=np.float64)
+    distances = station_distances.loc[stations, stations].to_numpy(dtype=np.float64)
+
+    # One (bucket, station, station) evaluation, normalised by each bucket's own total exits
+    factors = gravity_kernel(entries, exits, distances, exits.sum(axis=1))
+    return np.moveaxis(factors, 0, -1), buckets
+
+def tensor_slice(friction_tensor, unique_stations, buckets, bucket):
+    '''
+    Extracts the friction factor matrix of a single time bucket from a friction factor tensor, in the same dataframe form as
+    compute_factor_actuals, so that it can be passed to compare_factors or visualized as a heatmap.
+    Args:
+        friction_tensor: a numpy array of shape (stations, stations, buckets) from compute_factor_tensor
+        unique_stations: the array of MBTA stations used to compute friction_tensor
+        buckets: the list of time bucket labels returned by compute_factor_tensor
+        bucket: the label of the time bucket to extract
+    Returns:
+        friction_factors: a pandas dataframe/matrix holding the friction factors between MBTA stations in the given bucket
+    '''
+    stations = list(unique_stations)
+    return pd.DataFrame(friction_tensor[:, :, list(buckets).index(bucket)], index=stations, columns=stations)
 
 def compare_factors(friction_factor_estimates,
                     friction_factor_actuals,
@@ -106,30 +184,32 @@ def compare_factors(friction_factor_estimates,
         unique_stations: an array holding all MBTA stations for which data was scraped
     Returns:
         friction_ratios: a pandas dataframe/matrix holding ratios between friction factor actuals to friction factor estimates
+        (a scipy.sparse matrix when the friction factors are sparse matrices, which must both be aligned with unique_stations)
     '''
-    # Initialize a pandas dataframe that will hold ratios of actual friction factors to estimated friction factors
-    friction_ratios = pd.DataFrame(columns=list(unique_stations), index=list(unique_stations))
-    
-    for i in range(len(unique_stations)): # For every row in the friction_ratios dataframe
-        for j in range(len(unique_stations)): # For every column in the friction_ratios dataframe
-            try:
-                # Compute the actual to expected ratio
-                value = float(friction_factor_actuals.iloc[i][j]) / float(friction_factor_estimates.iloc[i][j])
-            except: # If dividing by zero
-                value = 0.0 # Coerce the result to be zero
-            # Add value as entry into friction_ratios dataframe
-            friction_ratios.iloc[i][j] = value
-    
-    return friction_ratios
-
-
-
-
-
-
-
-
-
-
-
-
+    if sparse.issparse(friction_factor_estimates):
+        # Sparse matrices carry no labels, and are compared over their stored pairs without densifying
+        return factor_ratios(friction_factor_estimates, friction_factor_actuals)
+    stations = list(unique_stations)
+    estimates = friction_factor_estimates.loc[stations, stations].to_numpy(dtype=np.float64)
+    actuals = friction_factor_actuals.loc[stations, stations].to_numpy(dtype=np.float64)
+    return pd.DataFrame(factor_ratios(estimates, actuals), index=stations, columns=stations)
+
+def factor_ratios(estimates, actuals):
+    '''
+    Computes the ratios of actual to estimated friction factors over aligned arrays.
+    Args:
+        estimates: an array of estimated friction factors, or a scipy.sparse matrix
+        actuals: an array of actual friction factors, of the same shape (a scipy.sparse matrix if estimates is one)
+    Returns:
+        ratios: a float64 numpy array of actuals / estimates, with zero wherever the estimate is zero; for sparse inputs a
+        scipy.sparse CSR matrix holding the ratio of every pair stored in both
+    '''
+    if sparse.issparse(estimates):
+        # Multiply by the reciprocal of the stored estimates, which only touches the stored pairs
+        reciprocal = sparse.csr_matrix(estimates, dtype=np.float64, copy=True)
+        reciprocal.data = np.divide(1.0, reciprocal.data, out=np.zeros_like(reciprocal.data), where=reciprocal.data != 0)
+        return sparse.csr_matrix(sparse.csr_matrix(actuals, dtype=np.float64).multiply(reciprocal))
+    estimates = np.asarray(estimates, dtype=np.float64)
+    actuals = np.asarray(actuals, dtype=np.float64)
+    # Compute the actual to expected ratio, coercing the result to zero wherever the estimate is zero
+    return np.divide(actuals, estimates, out=np.zeros_like(actuals), where=estimates != 0)
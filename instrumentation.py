@@ -0,0 +1,105 @@
+import cProfile
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+def _peak_rss_bytes():
+    '''
+    Returns the peak resident set size of this process so far, in bytes (None where it cannot be measured).
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class RunReport:
+    '''
+    Records wall time, CPU time, memory and row/cell counts for each stage of a pipeline run, and optionally profiles
+    one chosen stage with cProfile. A disabled report records nothing and adds no overhead.
+    Args:
+        enabled: whether to record anything at all
+        trace_memory: whether to track Python allocations with tracemalloc (slows allocation-heavy stages down)
+        profile_stage: the name of a stage to run under cProfile (None profiles nothing)
+        profile_path: the file to which the cProfile statistics of profile_stage are dumped
+    '''
+    def __init__(self, enabled=True, trace_memory=True, profile_stage=None, profile_path=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory and enabled
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path or (str(profile_stage) + '.prof')
+        self.stages = []
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Measures the code run inside a with block as one named stage.
+        Args:
+            name: the name of the stage
+        Yields:
+            counts: a dictionary into which the stage can record sizes, e.g. counts['rows'] = len(df)
+        '''
+        counts = {}
+        if not self.enabled:
+            yield counts
+            return
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield counts
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record = {'stage': name,
+                      'wall_seconds': time.perf_counter() - wall_start,
+                      'cpu_seconds': time.process_time() - cpu_start,
+                      'peak_rss_bytes': _peak_rss_bytes()}
+            if self.trace_memory:
+                memory_after, memory_peak = tracemalloc.get_traced_memory()
+                record['alloc_delta_bytes'] = memory_after - memory_before
+                record['alloc_peak_bytes'] = memory_peak - memory_before
+            if profiler is not None:
+                profiler.dump_stats(self.profile_path)
+                record['profile'] = self.profile_path
+            record.update(counts)
+            self.stages.append(record)
+
+    def to_dict(self):
+        '''
+        Returns the report as a JSON-serialisable dictionary.
+        '''
+        return {'started': self.started,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'total_wall_seconds': sum(stage['wall_seconds'] for stage in self.stages),
+                'stages': self.stages}
+
+    def write(self, path):
+        '''
+        Writes the report to a JSON file, and stops memory tracing.
+        Args:
+            path: the path of the JSON file
+        '''
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
@@ -1,66 +1,87 @@
-import math
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
 
-def station_dist_matrix(stations, station_lat, station_lon):
+# Mean radius of the Earth in kilometres, used by the haversine (great-circle) metric
+EARTH_RADIUS_KM = 6371.0088
+
+def pairwise_distances(lat_a, lon_a, lat_b, lon_b, metric='euclidean'):
+    '''
+    Computes the distances between two sets of coordinates in a single NumPy broadcast.
+    Args:
+        lat_a: an array of latitude coordinates for the first set of locations (rows of the result)
+        lon_a: an array of longitude coordinates for the first set of locations
+        lat_b: an array of latitude coordinates for the second set of locations (columns of the result)
+        lon_b: an array of longitude coordinates for the second set of locations
+        metric: 'euclidean' for the Euclidean distance in coordinate degrees, or 'haversine' for the great-circle
+        distance in kilometres
+    Returns:
+        distance: a float64 numpy array of shape (len(lat_a), len(lat_b)) whose entry (i,j) represents the distance
+        from location i of the first set to location j of the second set
+    '''
+    lat_a = np.asarray(lat_a, dtype=np.float64)[:, None]
+    lon_a = np.asarray(lon_a, dtype=np.float64)[:, None]
+    lat_b = np.asarray(lat_b, dtype=np.float64)[None, :]
+    lon_b = np.asarray(lon_b, dtype=np.float64)[None, :]
+
+    if metric == 'euclidean':
+        # Euclidean distance in coordinate degrees, as used by the original gravity model
+        return np.hypot(lat_a - lat_b, lon_a - lon_b)
+    if metric == 'haversine':
+        # Great-circle distance on a spherical Earth, in kilometres
+        phi_a, phi_b = np.radians(lat_a), np.radians(lat_b)
+        d_phi = phi_b - phi_a
+        d_lambda = np.radians(lon_b - lon_a)
+        h = np.sin(d_phi / 2.0) ** 2 + np.cos(phi_a) * np.cos(phi_b) * np.sin(d_lambda / 2.0) ** 2
+        # Clip guards against values marginally above 1 caused by floating point error
+        return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+    raise ValueError('Unknown distance metric: ' + str(metric))
+
+def station_dist_matrix(stations, station_lat, station_lon, metric='euclidean'):
     '''
-    Computes the Euclidean distances between MBTA stations.
+    Computes the distances between MBTA stations.
     Args:
         stations: an array of strings indicating the MBTA stations
-        lat: a dictionary with MBTA station keys and latitude coordinate values
-        lon: a dictionary with MBTA station keys and longitude coordinates values
+        station_lat: a dictionary with MBTA station keys and latitude coordinate values
+        station_lon: a dictionary with MBTA station keys and longitude coordinates values
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
     Returns:
-        distance: a pandas dataframe/matrix whose entry (i,j) represents the distance from station i to station j
+        distance: a float64 pandas dataframe/matrix whose entry (i,j) represents the distance from station i to station j
     '''
-    # Initialize distance matrix as a dataframe
-    distance = pd.DataFrame(columns=list(stations), index=list(stations))
-    
-    # Fill in distance matrix with Euclidean distances between stations
-    # Note: entry (i,j) is equivalent to entry (j,i)
-    for i in range(len(stations)):
-        for j in range(i+1, len(stations)):
-            lat_dist = station_lat[stations[i]] - station_lat[stations[j]]
-            lon_dist = station_lon[stations[i]] - station_lon[stations[j]]
-            # Compute distance
-            dist = math.sqrt((lat_dist ** 2) + (lon_dist ** 2))
-            distance.loc[stations[i]][stations[j]] = dist
-            distance.loc[stations[j]][stations[i]] = dist
-    
-    # Add zeros along horizontal of matrix
-    for i in range(len(distance)):
-        distance.iloc[i][i] = 0.0
-    
-    return distance
+    stations = list(stations)
+    # Gather coordinates once, in the same order as the matrix labels
+    lat = [station_lat[station] for station in stations]
+    lon = [station_lon[station] for station in stations]
 
-def zip_station_matrix(zip_lat, zip_lon, station_lat, station_lon):
+    # Entry (i,j) is equivalent to entry (j,i), and the diagonal is zero by construction
+    distance = pairwise_distances(lat, lon, lat, lon, metric=metric)
+    np.fill_diagonal(distance, 0.0)
+
+    return pd.DataFrame(distance, index=stations, columns=stations)
+
+def zip_station_matrix(zip_lat, zip_lon, station_lat, station_lon, metric='euclidean'):
     '''
-    Computes the Euclidean distances between zip code locations to MBTA stations.
+    Computes the distances between zip code locations and MBTA stations.
     Args:
         zip_lat: a dictionary with zip code keys and latitude coordinate values
         zip_lon: a dictionary with zip code keys and longitude coordinate values
         station_lat: a dictionary with MBTA station keys and latitude coordinate values
         station_lon: a dictionary with MBTA station keys and longitude coordinate values
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
     Returns:
-        distance: a dataframe/matrix whose entry (i,j) represents the distance from zip code i to station j
+        distance: a float64 dataframe/matrix whose entry (i,j) represents the distance from station i to zip code j
     '''
     # Get list of all unique zip codes
-    zips = [key for key in zip_lat]
+    zips = list(zip_lat)
     # Get list of all unique MBTA stations
-    stations = [key for key in station_lat]
-    
-    # Instantiate distance matrix as a dataframe: indices = stations, column names = zip codes
-    distance = pd.DataFrame(index=list(stations), columns=list(zips))
-    
-    # Fill in distance matrix with Euclidean distances between zip codes and stations
-    for i in range(len(zips)):
-        for j in range(len(stations)):
-            lat_dist = station_lat[stations[j]] - zip_lat[zips[i]]
-            lon_dist = station_lon[stations[j]] - zip_lon[zips[i]]
-            # Compute distance
-            dist = math.sqrt((lat_dist ** 2) + (lon_dist ** 2))
-            distance.loc[stations[j]][zips[i]] = dist
+    stations = list(station_lat)
 
-    return distance
+    # Distance matrix: indices = stations, column names = zip codes
+    distance = pairwise_distances([station_lat[s] for s in stations], [station_lon[s] for s in stations],
+                                  [zip_lat[z] for z in zips], [zip_lon[z] for z in zips], metric=metric)
+
+    return pd.DataFrame(distance, index=stations, columns=zips)
 
 def zip_closest_stations(station_zip_dist):
     '''
@@ -70,21 +91,241 @@ def zip_closest_stations(station_zip_dist):
     Returns:
         zip_closest_station: a dictionary with zip code keys and station values
     '''
-    # Initialize dictionary
-    zip_closest_station = {}
-    # Get list of all zip codes
-    zip_cols = station_zip_dist.columns
-    for i in range(station_zip_dist.shape[1]): # For every column in dataframe
-        # Initialize min_dist to an arbitrarily large value
-        min_dist = 10
-        for j in range(station_zip_dist.shape[0]): # For every row in dataframe
-            if station_zip_dist.iloc[j][i] < min_dist: # If distance from zip code to station is less than min_dist
-                min_dist = station_zip_dist.iloc[j][i] # Set min_dist to this minimum value
-                # Retrieve the name of the station (index) that corresponds to min_dist
-                closest_station = station_zip_dist[station_zip_dist[zip_cols[i]]==min_dist].index.item()
-                # Update zip_closest_station dictionary
-                zip_closest_station[zip_cols[i]] = closest_station
-    return zip_closest_station    
+    # Take the station (row) with the smallest distance in every zip code (column)
+    # Ties resolve to the first station in the index, rather than raising as a boolean mask lookup would
+    closest = station_zip_dist.astype(np.float64).idxmin(axis=0)
+    return closest.to_dict()
+
+def _coords_to_points(lat, lon, metric):
+    '''
+    Converts latitude, longitude coordinates into points for a KD-tree, so that tree distances preserve the ordering of metric.
+    Args:
+        lat: an array of latitude coordinates
+        lon: an array of longitude coordinates
+        metric: 'euclidean' (coordinate degrees) or 'haversine' (great-circle kilometres)
+    Returns:
+        points: a float64 numpy array of shape (n, 2) for 'euclidean', or of shape (n, 3) holding Cartesian coordinates
+        on a sphere of radius EARTH_RADIUS_KM for 'haversine'
+    '''
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if metric == 'euclidean':
+        return np.column_stack((lat, lon))
+    if metric == 'haversine':
+        # Straight-line (chord) distance through the sphere is monotonic in great-circle distance
+        phi, lam = np.radians(lat), np.radians(lon)
+        return EARTH_RADIUS_KM * np.column_stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)))
+    raise ValueError('Unknown distance metric: ' + str(metric))
+
+def _chord_to_arc(chord):
+    '''
+    Converts chord lengths on the Earth sphere into great-circle distances in kilometres.
+    '''
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / (2.0 * EARTH_RADIUS_KM), 0.0, 1.0))
+
+def _arc_to_chord(arc):
+    '''
+    Converts great-circle distances in kilometres into chord lengths on the Earth sphere.
+    '''
+    return 2.0 * EARTH_RADIUS_KM * np.sin(np.minimum(np.asarray(arc) / (2.0 * EARTH_RADIUS_KM), np.pi / 2.0))
+
+def coords_tree(lat, lon, metric='euclidean'):
+    '''
+    Builds a KD-tree spatial index over arrays of coordinates.
+    Args:
+        lat: an array of latitude coordinates
+        lon: an array of longitude coordinates
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        tree: a scipy cKDTree whose point i is location i
+    '''
+    return cKDTree(_coords_to_points(lat, lon, metric))
+
+def station_tree(station_lat, station_lon, metric='euclidean'):
+    '''
+    Builds a KD-tree spatial index over MBTA station coordinates.
+    Args:
+        station_lat: a dictionary with MBTA station keys and latitude coordinate values
+        station_lon: a dictionary with MBTA station keys and longitude coordinate values
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        tree: a scipy cKDTree whose point i is station i of stations
+        stations: a list of station names in tree order
+    '''
+    stations = list(station_lat)
+    return coords_tree([station_lat[s] for s in stations], [station_lon[s] for s in stations], metric), stations
+
+def nearest_stations(zip_lat, zip_lon, station_lat, station_lon, k=1, metric='euclidean'):
+    '''
+    Finds the k nearest MBTA stations to each zip code (or any other set of points) using a KD-tree, without building
+    the full zip code by station distance matrix.
+    Args:
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+        station_lat: a dictionary with MBTA station keys and latitude coordinate values
+        station_lon: a dictionary with MBTA station keys and longitude coordinate values
+        k: the number of nearest stations to return for each zip code
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        zip_nearest: a dictionary with zip code keys and station values when k is 1, or lists of the k nearest stations
+        (nearest first) otherwise
+        zip_distance: a dictionary with the same keys and the corresponding distance(s) in the units of metric
+    '''
+    tree, stations = station_tree(station_lat, station_lon, metric)
+    zips = list(zip_lat)
+    # Never ask for more neighbours than there are stations
+    n_neighbours = min(int(k), len(stations))
+    points = _coords_to_points([zip_lat[z] for z in zips], [zip_lon[z] for z in zips], metric)
+    dist, idx = tree.query(points, k=n_neighbours)
+    if metric == 'haversine':
+        dist = _chord_to_arc(dist)
+
+    names = np.asarray(stations, dtype=object)[idx]
+    if k == 1:
+        return dict(zip(zips, names.tolist())), dict(zip(zips, dist.tolist()))
+    # Keep a 2D shape when only one station is available
+    names = names.reshape(len(zips), n_neighbours)
+    dist = np.asarray(dist).reshape(len(zips), n_neighbours)
+    return dict(zip(zips, names.tolist())), dict(zip(zips, dist.tolist()))
+
+def stations_within_radius(zip_lat, zip_lon, station_lat, station_lon, radius, metric='euclidean'):
+    '''
+    Finds every MBTA station within a given radius of each zip code (or any other set of points) using a KD-tree.
+    Args:
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+        station_lat: a dictionary with MBTA station keys and latitude coordinate values
+        station_lon: a dictionary with MBTA station keys and longitude coordinate values
+        radius: the search radius, in the units of metric
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        zip_stations: a dictionary with zip code keys and values that are lists of the stations within radius,
+        nearest first (empty when no station is in range)
+    '''
+    tree, stations = station_tree(station_lat, station_lon, metric)
+    zips = list(zip_lat)
+    points = _coords_to_points([zip_lat[z] for z in zips], [zip_lon[z] for z in zips], metric)
+    search_radius = _arc_to_chord(radius) if metric == 'haversine' else radius
+    matches = tree.query_ball_point(points, r=search_radius)
+
+    zip_stations = {}
+    for zip_code, point, idx in zip(zips, points, matches):
+        # Order the (typically few) matches by their distance from the zip code
+        idx = np.asarray(idx, dtype=np.intp)
+        order = np.argsort(np.linalg.norm(tree.data[idx] - point, axis=1), kind='stable')
+        zip_stations[zip_code] = [stations[i] for i in idx[order]]
+    return zip_stations
+
+def nearest_station_ids(registry, lat, lon, k=1, metric='euclidean'):
+    '''
+    Finds the k nearest stations of a station registry to each of a set of points (e.g. zip codes or census blocks).
+    Args:
+        registry: a station_registry.StationRegistry
+        lat: an array of latitude coordinates of the points
+        lon: an array of longitude coordinates of the points
+        k: the number of nearest stations to return for each point
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        ids: an integer array of station IDs, of shape (points,) when k is 1 or (points, k) otherwise (nearest first)
+        distances: a float64 array of the same shape holding the corresponding distances in the units of metric
+    '''
+    k = min(int(k), len(registry))
+    dist, ids = registry.tree(metric).query(_coords_to_points(lat, lon, metric), k=k)
+    if metric == 'haversine':
+        dist = _chord_to_arc(dist)
+    return ids.astype(np.intp), np.asarray(dist, dtype=np.float64)
+
+def registry_dist_matrix(registry, ids=None, metric='euclidean'):
+    '''
+    Computes the distances between stations of a station registry.
+    Args:
+        registry: a station_registry.StationRegistry
+        ids: an array of the station IDs to include, in matrix order (every station if None)
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        distance: a float64 numpy array whose entry (i,j) represents the distance from station ids[i] to station ids[j]
+    '''
+    lat, lon = registry.coords(ids)
+    distance = pairwise_distances(lat, lon, lat, lon, metric=metric)
+    np.fill_diagonal(distance, 0.0)
+    return distance
+
+def sparse_dist_matrix(lat, lon, radius=None, k=None, metric='euclidean', tree=None):
+    '''
+    Computes the distances between only the nearby pairs of a set of locations, using a KD-tree, and stores them as a
+    sparse matrix. Memory scales with the number of pairs kept (about n * k) rather than with n * n.
+    Args:
+        lat: an array of latitude coordinates
+        lon: an array of longitude coordinates
+        radius: keep pairs at most this far apart, in the units of metric (no limit if None)
+        k: keep each location's k nearest neighbours (within radius, if given), and the reverse pairs so that the
+        matrix is symmetric (no limit if None)
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+        tree: a KD-tree over the same locations and metric, as built by coords_tree (built here if None)
+    Returns:
+        distance: a scipy.sparse CSR matrix of shape (n, n) whose stored entry (i,j) is the distance from location i to
+        location j; pairs that are not kept, and the diagonal, are not stored
+    '''
+    if radius is None and k is None:
+        raise ValueError('A sparse distance matrix needs a radius, k, or both')
+    tree = coords_tree(lat, lon, metric) if tree is None else tree
+    n = tree.n
+    # The tree works in chord lengths for 'haversine', so the radius is converted to a chord too
+    bound = None if radius is None else (_arc_to_chord(radius) if metric == 'haversine' else radius)
+
+    if k is None:
+        pairs = tree.sparse_distance_matrix(tree, bound, output_type='coo_matrix')
+        rows, cols, dist = pairs.row, pairs.col, pairs.data
+    else:
+        # Ask for k + 1 neighbours, as every location is its own nearest neighbour
+        neighbours = np.arange(1, min(int(k) + 1, n) + 1)
+        dist, cols = tree.query(tree.data, k=neighbours, distance_upper_bound=np.inf if bound is None else bound)
+        rows = np.repeat(np.arange(n), len(neighbours))
+        dist, cols = dist.ravel(), cols.ravel()
+        # Missing neighbours (beyond the radius) are reported with index n
+        found = cols < n
+        rows, cols, dist = rows[found], cols[found], dist[found]
+        # Add the reverse of every pair, dropping the duplicates where i and j are each other's neighbours
+        rows, cols, dist = np.concatenate([rows, cols]), np.concatenate([cols, rows]), np.concatenate([dist, dist])
+        _, first = np.unique(rows.astype(np.int64) * n + cols, return_index=True)
+        rows, cols, dist = rows[first], cols[first], dist[first]
+
+    off_diagonal = rows != cols
+    rows, cols, dist = rows[off_diagonal], cols[off_diagonal], np.asarray(dist[off_diagonal], dtype=np.float64)
+    if metric == 'haversine':
+        dist = _chord_to_arc(dist)
+    return sparse.csr_matrix((dist, (rows, cols)), shape=(n, n))
+
+def registry_sparse_dist_matrix(registry, ids=None, radius=None, k=None, metric='euclidean'):
+    '''
+    Computes the distances between the nearby pairs of stations of a station registry, as sparse_dist_matrix does.
+    Args:
+        registry: a station_registry.StationRegistry
+        ids: an array of the station IDs to include, in matrix order (every station if None)
+        radius: keep pairs at most this far apart, in the units of metric (no limit if None)
+        k: keep each station's k nearest neighbours (no limit if None)
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    Returns:
+        distance: a scipy.sparse CSR matrix whose stored entry (i,j) is the distance from station ids[i] to station ids[j]
+    '''
+    if ids is None:
+        # The registry's own tree covers exactly every station, so it can be reused
+        return sparse_dist_matrix(registry.lat, registry.lon, radius, k, metric, tree=registry.tree(metric))
+    lat, lon = registry.coords(ids)
+    return sparse_dist_matrix(lat, lon, radius, k, metric)
+
+def station_popularity_array(registry, station_ids, population):
+    '''
+    Computes the popularity of every station of a station registry as the total population of the points assigned to it.
+    Args:
+        registry: a station_registry.StationRegistry
+        station_ids: an integer array holding the ID of the station each point is assigned to
+        population: an array holding the population of each point
+    Returns:
+        popularity: a float64 array indexed by station ID
+    '''
+    return np.bincount(np.asarray(station_ids, dtype=np.intp), weights=np.asarray(population, dtype=np.float64),
+                       minlength=len(registry))
 
 def station_popularities(zip_closest_station, zip_pop):
     '''
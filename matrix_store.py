@@ -0,0 +1,184 @@
+import json
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+def _paths(path):
+    # A matrix is stored as <path>.npy with its axis labels in <path>.labels.json
+    base = path[:-4] if path.endswith('.npy') else path
+    return base + '.npy', base + '.labels.json'
+
+def _sparse_paths(path):
+    # A sparse matrix is stored as <path>.npz (scipy.sparse.save_npz) with its axis labels in <path>.labels.json
+    base = path[:-4] if path.endswith('.npz') else path
+    return base + '.npz', base + '.labels.json'
+
+def _to_builtin(label):
+    # Numpy scalars (e.g. integer hour-of-day buckets) are not JSON serialisable
+    return label.item() if isinstance(label, np.generic) else label
+
+def _save_labels(labels_path, labels, shape):
+    if len(labels) != len(shape) or any(len(axis) != size for axis, size in zip(labels, shape)):
+        raise ValueError('Labels do not match the shape of the matrix: ' + str(shape))
+    with open(labels_path, 'w') as f:
+        json.dump({'axes': [[_to_builtin(label) for label in axis] for axis in labels]}, f)
+
+def save_matrix(path, values, labels, dtype=np.float64):
+    '''
+    Saves a friction factor matrix (or tensor) as a binary .npy file plus a JSON sidecar holding its axis labels, so
+    that it can later be memory-mapped and sliced without reading the whole file.
+    Args:
+        path: the path of the matrix, with or without the .npy extension
+        values: a numpy array of any number of dimensions
+        labels: a list holding the labels of each axis of values (e.g. [stations, stations, buckets])
+        dtype: the dtype to store the values as (e.g. np.float32 to halve the file size)
+    Returns:
+        path: the path of the .npy file written
+    '''
+    npy_path, labels_path = _paths(path)
+    values = np.asarray(values)
+    _save_labels(labels_path, labels, values.shape)
+    np.save(npy_path, values.astype(dtype, copy=False))
+    return npy_path
+
+def save_frame(path, frame, dtype=np.float64):
+    '''
+    Saves a labelled friction factor dataframe/matrix with save_matrix.
+    Args:
+        path: the path of the matrix, with or without the .npy extension
+        frame: a pandas dataframe
+        dtype: the dtype to store the values as
+    Returns:
+        path: the path of the .npy file written
+    '''
+    return save_matrix(path, frame.to_numpy(dtype=dtype), [list(frame.index), list(frame.columns)], dtype)
+
+class StoredMatrix:
+    '''
+    A matrix (or tensor) written by save_matrix, opened as a read-only memory map so that slices only read the rows they
+    touch from disk.
+    Args:
+        path: the path of the matrix, with or without the .npy extension
+        mmap: whether to memory-map the values (False loads them into memory)
+    '''
+    def __init__(self, path, mmap=True):
+        npy_path, labels_path = _paths(path)
+        self.values = np.load(npy_path, mmap_mode='r' if mmap else None)
+        with open(labels_path) as f:
+            self.labels = json.load(f)['axes']
+        self._positions = [{label: i for i, label in enumerate(axis)} for axis in self.labels]
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def positions(self, axis, labels):
+        '''
+        Converts labels along an axis into integer positions.
+        '''
+        return np.array([self._positions[axis][label] for label in labels], dtype=np.intp)
+
+    def frame(self, rows=None, columns=None, index=()):
+        '''
+        Reads a labelled two-dimensional slice of the matrix into a dataframe.
+        Args:
+            rows: the row labels to read (all rows if None)
+            columns: the column labels to read (all columns if None)
+            index: for tensors, the labels of the remaining axes to fix (e.g. (bucket,) for a stations x stations x buckets
+            tensor)
+        Returns:
+            frame: a pandas dataframe/matrix holding the selected values
+        '''
+        rows = self.labels[0] if rows is None else list(rows)
+        columns = self.labels[1] if columns is None else list(columns)
+        fixed = tuple(self._positions[axis + 2][label] for axis, label in enumerate(index))
+        row_positions = self.positions(0, rows)
+        column_positions = self.positions(1, columns)
+        # Index rows first, so that only the selected rows are read from the memory map
+        block = self.values[row_positions]
+        block = block[(slice(None), column_positions) + fixed]
+        return pd.DataFrame(np.asarray(block), index=rows, columns=columns)
+
+def load_matrix(path, mmap=True):
+    '''
+    Opens a matrix written by save_matrix.
+    Args:
+        path: the path of the matrix, with or without the .npy extension
+        mmap: whether to memory-map the values rather than load them into memory
+    Returns:
+        matrix: a StoredMatrix
+    '''
+    return StoredMatrix(path, mmap)
+
+def export_csv(path, csv_path, index=(), chunk_rows=1024, float_format=None):
+    '''
+    Exports a stored matrix (or one two-dimensional slice of a stored tensor) to CSV, in the same layout as
+    DataFrame.to_csv, streaming a chunk of rows at a time so that memory use does not grow with the matrix.
+    Args:
+        path: the path of the matrix, with or without the .npy extension
+        csv_path: the path of the CSV file to write
+        index: for tensors, the labels of the remaining axes to fix (see StoredMatrix.frame)
+        chunk_rows: the number of rows read and written at a time
+        float_format: a format string for the values, as in DataFrame.to_csv (full precision if None)
+    '''
+    matrix = load_matrix(path)
+    fixed = tuple(matrix._positions[axis + 2][label] for axis, label in enumerate(index))
+    rows, columns = matrix.labels[0], matrix.labels[1]
+    with open(csv_path, 'w', newline='') as f:
+        for start in range(0, len(rows), chunk_rows):
+            block = np.asarray(matrix.values[(slice(start, start + chunk_rows), slice(None)) + fixed])
+            chunk = pd.DataFrame(block, index=rows[start:start + chunk_rows], columns=columns)
+            # Only the first chunk writes the header row
+            chunk.to_csv(f, header=start == 0, float_format=float_format)
+
+def save_sparse_matrix(path, matrix, labels, dtype=np.float64):
+    '''
+    Saves a sparse friction factor (or distance) matrix as a compressed .npz file (scipy.sparse.save_npz) plus a JSON
+    sidecar holding its axis labels. Only the stored pairs are written.
+    Args:
+        path: the path of the matrix, with or without the .npz extension
+        matrix: a scipy.sparse matrix
+        labels: a list holding the row labels and the column labels of matrix
+        dtype: the dtype to store the values as
+    Returns:
+        path: the path of the .npz file written
+    '''
+    npz_path, labels_path = _sparse_paths(path)
+    _save_labels(labels_path, labels, matrix.shape)
+    sparse.save_npz(npz_path, sparse.csr_matrix(matrix, dtype=dtype))
+    return npz_path
+
+def load_sparse_matrix(path):
+    '''
+    Loads a sparse matrix written by save_sparse_matrix.
+    Args:
+        path: the path of the matrix, with or without the .npz extension
+    Returns:
+        matrix: a scipy.sparse CSR matrix
+        labels: a list holding the row labels and the column labels of matrix
+    '''
+    npz_path, labels_path = _sparse_paths(path)
+    with open(labels_path) as f:
+        labels = json.load(f)['axes']
+    return sparse.csr_matrix(sparse.load_npz(npz_path)), labels
+
+def export_sparse_csv(path, csv_path, chunk_rows=4096, float_format=None, columns=('origin', 'destination', 'value')):
+    '''
+    Exports a sparse matrix written by save_sparse_matrix to CSV in long format, with one line per stored pair, streaming a
+    chunk of rows at a time.
+    Args:
+        path: the path of the matrix, with or without the .npz extension
+        csv_path: the path of the CSV file to write
+        chunk_rows: the number of matrix rows written at a time
+        float_format: a format string for the values, as in DataFrame.to_csv (full precision if None)
+        columns: the header of the row label, column label and value columns
+    '''
+    matrix, (rows, cols) = load_sparse_matrix(path)
+    rows, cols = np.asarray(rows, dtype=object), np.asarray(cols, dtype=object)
+    with open(csv_path, 'w', newline='') as f:
+        for start in range(0, matrix.shape[0], chunk_rows):
+            block = matrix[start:start + chunk_rows].tocoo()
+            chunk = pd.DataFrame({columns[0]: rows[block.row + start], columns[1]: cols[block.col], columns[2]: block.data})
+            # Only the first chunk writes the header row
+            chunk.to_csv(f, header=start == 0, index=False, float_format=float_format)
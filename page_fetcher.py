@@ -0,0 +1,142 @@
+import functools
+import hashlib
+import http.server
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class PageFetcher:
+    '''
+    Fetches web pages over a pooled HTTP session with bounded concurrency, retry with backoff, and an on-disk response
+    cache, so that a warm run makes no network calls at all.
+    Args:
+        cache_dir: directory in which successful responses are cached (None disables the cache)
+        ttl: number of seconds a cached response stays fresh (None means cached responses never expire)
+        max_workers: maximum number of requests in flight at once
+        timeout: number of seconds to wait for a server response before retrying
+        retries: number of times a failed request (connection error or 429/5xx status) is retried
+        backoff: backoff factor in seconds; retry n waits backoff * 2 ** (n - 1) seconds
+    '''
+    def __init__(self, cache_dir='./.cache/pages', ttl=30 * 24 * 3600, max_workers=8, timeout=10, retries=3, backoff=0.5):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.timeout = timeout
+        # Number of requests actually sent over the network (cache hits are not counted)
+        self.network_calls = 0
+        self._lock = threading.Lock()
+
+        # One session shared across threads, with a connection pool large enough for every worker
+        retry = Retry(total=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_path(self, url):
+        # Cache files are named after a hash of the URL (ignoring any #fragment, which is never sent to the server)
+        key = hashlib.sha1(url.split('#')[0].encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.html')
+
+    def _read_cache(self, url):
+        if self.cache_dir is None:
+            return None
+        path = self._cache_path(url)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if self.ttl is not None and age > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_cache(self, url, content):
+        if self.cache_dir is None:
+            return
+        path = self._cache_path(url)
+        # Write to a temporary file first so that concurrent readers never see a partial page
+        tmp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def fetch(self, url):
+        '''
+        Fetches a single web page, serving it from the cache when a fresh copy exists.
+        Args:
+            url: the URL of the page
+        Returns:
+            status_code: the HTTP status code (200 for cache hits)
+            content: the raw bytes of the page
+        '''
+        content = self._read_cache(url)
+        if content is not None:
+            return 200, content
+
+        with self._lock:
+            self.network_calls += 1
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException:
+            # Retries are exhausted; report the failure the same way as a bad status code
+            return 0, b''
+        # Only cache successful responses, so that errors are retried on the next run
+        if response.status_code == 200:
+            self._write_cache(url, response.content)
+        return response.status_code, response.content
+
+    def fetch_many(self, urls):
+        '''
+        Fetches many web pages concurrently.
+        Args:
+            urls: a list of page URLs
+        Returns:
+            results: a list of (status_code, content) tuples in the same order as urls
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.fetch, urls))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def serve_directory(directory, host='127.0.0.1', port=0):
+    '''
+    Serves a directory of saved pages over HTTP in a background thread, as a local stand-in for a live web site.
+    A directory that mirrors the site's paths (e.g. city/ma-boston.asp, zip-code/02108/zip-code-02108.asp) can be passed
+    as the base URL of get_zip_coords.
+    Args:
+        directory: the directory to serve
+        host: the interface to bind to
+        port: the port to bind to (0 picks a free port)
+    Returns:
+        server: the running http.server instance (call server.shutdown() to stop it)
+        base_url: the URL at which the directory is served, with a trailing slash
+    '''
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://' + host + ':' + str(server.server_address[1]) + '/'
@@ -0,0 +1,323 @@
+'''
+Runs the friction factor comparison as a graph of memoized stages. Each stage is keyed by a hash of its code, its
+parameters, any input files, and the content of its upstream outputs, so re-running after a change only recomputes the
+stages that the change actually affects. Independent branches (the zip code scrape and the turnstile aggregation) run
+concurrently.
+
+Run from the repository root, e.g.:
+    python pipeline.py                  # run every stage
+    python pipeline.py actuals          # run only what the actuals stage needs
+    python pipeline.py --force zips     # recompute the zip code scrape and everything downstream of it
+'''
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import coordinate_locations as cl
+import friction_factors as ff
+import location_distances as ld
+import turnstile_data as td
+import zip_pages as zp
+import station_registry
+from station_registry import StationRegistry
+
+# Directory in which stage outputs are memoized
+PIPELINE_CACHE_DIR = './.cache/pipeline'
+
+# Modules of this repository are the ones whose source is part of stage keys
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _local_modules(module):
+    # Repository modules that module uses, either imported whole or through names imported from them
+    used = set()
+    for value in vars(module).values():
+        source = value if inspect.ismodule(value) else sys.modules.get(getattr(value, '__module__', None) or '')
+        path = getattr(source, '__file__', None)
+        if source is not None and source is not module and path and os.path.dirname(os.path.abspath(path)) == _REPO_DIR:
+            used.add(source)
+    return used
+
+def module_closure(modules):
+    '''
+    Finds every repository module that the given modules use, directly or through other repository modules.
+    Args:
+        modules: an iterable of modules
+    Returns:
+        modules: a list of the modules and everything they use, sorted by name
+    '''
+    seen = {}
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module.__name__ not in seen:
+            seen[module.__name__] = module
+            pending.extend(_local_modules(module))
+    return [seen[name] for name in sorted(seen)]
+
+class Stage:
+    '''
+    A single step of the pipeline.
+    Args:
+        name: the unique name of the stage
+        func: a function called with the outputs of deps as keyword arguments (named after the stages), plus params
+        deps: the names of the stages whose outputs func needs
+        params: a dictionary of extra keyword arguments for func, which are part of the stage's key
+        modules: the modules func calls into. The whole source of each, and of every repository module they use in turn,
+        is part of the stage's key (as is func's own source), so a change to any helper or module-level constant they
+        depend on invalidates the stage
+        files: a function returning the paths of input files whose size and modification time are part of the stage's key
+    '''
+    def __init__(self, name, func, deps=(), params=None, modules=(), files=None):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.params = params or {}
+        self.modules = module_closure(modules)
+        self.files = files
+
+    def key(self, dep_hashes):
+        '''
+        Hashes everything that determines the stage's output.
+        Args:
+            dep_hashes: a dictionary with the content hash of every upstream output
+        Returns:
+            key: a hex digest identifying this stage's inputs
+        '''
+        sha = hashlib.sha1(self.name.encode('utf-8'))
+        sha.update(inspect.getsource(self.func).encode('utf-8'))
+        for module in self.modules:
+            sha.update(module.__name__.encode('utf-8'))
+            sha.update(inspect.getsource(module).encode('utf-8'))
+        sha.update(repr(sorted(self.params.items())).encode('utf-8'))
+        for dep in self.deps:
+            sha.update(dep_hashes[dep].encode('utf-8'))
+        if self.files is not None:
+            for path in sorted(self.files()):
+                stat = os.stat(path)
+                sha.update(repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        return sha.hexdigest()
+
+def _zips(table_path):
+    return cl.get_zip_coords(table_path=table_path)
+
+def _station_coords(coords):
+    return StationRegistry.from_coords(coords).lat_lon_dicts()
+
+def _turnstile(paths):
+    # Aggregate every station, so that this branch does not depend on (and can run alongside) the zip code scrape
+    return td.cached_turnstile_totals(paths)
+
+def _catchment(zips, station_coords):
+    zip_pop, zip_lat, zip_lon = zips
+    station_lat, station_lon = station_coords
+    zip_closest_station, _ = ld.nearest_stations(zip_lat, zip_lon, station_lat, station_lon)
+    return zip_closest_station
+
+def _popularity(catchment, zips):
+    return ld.station_popularities(catchment, zips[0])
+
+def _distances(popularity, station_coords, metric):
+    station_lat, station_lon = station_coords
+    return ld.station_dist_matrix(popularity[0], station_lat, station_lon, metric=metric)
+
+def _estimates(popularity, distances):
+    unique_stations, station_popularity, total_pop = popularity
+    return ff.compute_factor_estimates(unique_stations, station_popularity, distances, total_pop)
+
+def _actuals(turnstile, popularity, distances):
+    return ff.compute_factor_actuals_from_totals(turnstile, popularity[0], distances)
+
+def _compare(estimates, actuals, popularity):
+    return ff.compare_factors(estimates, actuals, popularity[0])
+
+def build_stages(turnstile_paths=td.TURNSTILE_DIR, metric='euclidean', zip_table=None):
+    '''
+    Builds the stages of the friction factor comparison.
+    Args:
+        turnstile_paths: a turnstile data file, a directory of turnstile data files, or a list of either
+        metric: the distance metric between stations ('euclidean' or 'haversine')
+        zip_table: a zip code attribute table written by zip_pages.py, loaded instead of scraping (None scrapes)
+    Returns:
+        stages: a dictionary with stage name keys and Stage values
+    '''
+    stages = [Stage('zips', _zips, params={'table_path': zip_table}, modules=(cl, zp),
+                    files=lambda: [zip_table] if zip_table is not None else []),
+              Stage('station_coords', _station_coords, params={'coords': cl.STATION_COORDS}, modules=(station_registry,)),
+              Stage('turnstile', _turnstile, params={'paths': turnstile_paths}, modules=(td,),
+                    files=lambda: td._turnstile_files(turnstile_paths)),
+              Stage('catchment', _catchment, deps=('zips', 'station_coords'), modules=(ld,)),
+              Stage('popularity', _popularity, deps=('catchment', 'zips'), modules=(ld,)),
+              Stage('distances', _distances, deps=('popularity', 'station_coords'), params={'metric': metric}, modules=(ld,)),
+              Stage('estimates', _estimates, deps=('popularity', 'distances'), modules=(ff,)),
+              Stage('actuals', _actuals, deps=('turnstile', 'popularity', 'distances'), modules=(ff,)),
+              Stage('compare', _compare, deps=('estimates', 'actuals', 'popularity'), modules=(ff,))]
+    return {stage.name: stage for stage in stages}
+
+def content_hash(value):
+    '''
+    Hashes the content of a stage output. Dataframes and arrays are hashed by their labels and values rather than their
+    pickled bytes, which can differ between equal objects (e.g. with a different internal memory layout).
+    Args:
+        value: a stage output (a dataframe, series, array, or a tuple/list/dictionary of these or of plain values)
+    Returns:
+        content_hash: a hex digest of the value
+    '''
+    sha = hashlib.sha1()
+    def update(value):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            sha.update(repr((type(value).__name__, value.shape, [str(d) for d in np.atleast_1d(value.dtypes)])).encode('utf-8'))
+            if isinstance(value, pd.DataFrame):
+                sha.update(repr(list(value.columns)).encode('utf-8'))
+            sha.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        elif isinstance(value, np.ndarray):
+            sha.update(repr((value.shape, value.dtype.str)).encode('utf-8'))
+            sha.update(np.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (tuple, list)):
+            sha.update(repr((type(value).__name__, len(value))).encode('utf-8'))
+            for item in value:
+                update(item)
+        elif isinstance(value, dict):
+            sha.update(repr(('dict', len(value))).encode('utf-8'))
+            for key, item in value.items():
+                update(key)
+                update(item)
+        else:
+            sha.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    update(value)
+    return sha.hexdigest()
+
+class Pipeline:
+    '''
+    Runs a graph of stages, memoizing each stage's output on disk under a key derived from its inputs.
+    Args:
+        stages: a dictionary with stage name keys and Stage values
+        cache_dir: the directory in which stage outputs are memoized
+        max_workers: the maximum number of stages run at once
+    '''
+    def __init__(self, stages, cache_dir=PIPELINE_CACHE_DIR, max_workers=4):
+        self.stages = stages
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        os.makedirs(cache_dir, exist_ok=True)
+        self._values = {}
+        self._lock = threading.Lock()
+        # Names of the stages that were recomputed (rather than read from the cache) by the last run
+        self.computed = []
+
+    def _required(self, targets):
+        # All stages the targets depend on, in dependency order
+        order = []
+        def visit(name, path=()):
+            if name in path:
+                raise ValueError('Dependency cycle: ' + ' -> '.join(path + (name,)))
+            if name not in self.stages:
+                raise ValueError('Unknown stage: ' + str(name))
+            if name in order:
+                return
+            for dep in self.stages[name].deps:
+                visit(dep, path + (name,))
+            order.append(name)
+        for target in targets:
+            visit(target)
+        return order
+
+    def _paths(self, name, key):
+        base = os.path.join(self.cache_dir, name + '-' + key)
+        return base + '.pkl', base + '.json'
+
+    def _value(self, name, key):
+        # Load a memoized output the first time a downstream stage (or the caller) actually needs it
+        with self._lock:
+            if name not in self._values:
+                with open(self._paths(name, key)[0], 'rb') as f:
+                    self._values[name] = pickle.load(f)
+            return self._values[name]
+
+    def _resolve(self, name, dep_futures, forced):
+        stage = self.stages[name]
+        # Wait for upstream stages; each resolves to (key, content hash) of its output
+        deps = {dep: future.result() for dep, future in dep_futures.items()}
+        key = stage.key({dep: dep_hash for dep, (_, dep_hash) in deps.items()})
+        value_path, meta_path = self._paths(name, key)
+
+        if name not in forced and os.path.exists(meta_path) and os.path.exists(value_path):
+            with open(meta_path) as f:
+                return key, json.load(f)['content_hash']
+
+        inputs = {dep: self._value(dep, dep_key) for dep, (dep_key, _) in deps.items()}
+        value = stage.func(**inputs, **stage.params)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        output_hash = content_hash(value)
+
+        # Write the output before its metadata, so that a memo is only ever visible once it is complete
+        tmp_path = value_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, value_path)
+        with open(meta_path, 'w') as f:
+            json.dump({'stage': name, 'content_hash': output_hash}, f)
+        with self._lock:
+            self._values[name] = value
+            self.computed.append(name)
+        return key, output_hash
+
+    def run(self, targets=None, force=()):
+        '''
+        Runs the stages needed for the given targets, reusing memoized outputs wherever a stage's inputs are unchanged.
+        Args:
+            targets: a list of stage names to produce (every stage if None)
+            force: a list of stage names to recompute even if they are memoized (downstream stages recompute whenever
+            the forced output changes)
+        Returns:
+            outputs: a dictionary with target stage name keys and their output values
+        '''
+        targets = list(self.stages) if targets is None else list(targets)
+        order = self._required(targets)
+        forced = set(force)
+        self._values = {}
+        self.computed = []
+
+        futures = {}
+        # Stages are submitted in dependency order, so a stage is never queued ahead of the stages it waits on
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for name in order:
+                dep_futures = {dep: futures[dep] for dep in self.stages[name].deps}
+                futures[name] = executor.submit(self._resolve, name, dep_futures, forced)
+            keys = {name: future.result()[0] for name, future in futures.items()}
+        return {target: self._value(target, keys[target]) for target in targets}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the friction factor comparison as a memoized graph of stages.')
+    parser.add_argument('targets', nargs='*', help='stages to produce (default: all)')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to recompute even if memoized')
+    parser.add_argument('--turnstile', default=td.TURNSTILE_DIR, help='turnstile data file or directory')
+    parser.add_argument('--zip-table', help='zip code table written by zip_pages.py, loaded instead of scraping')
+    parser.add_argument('--metric', default='euclidean', choices=['euclidean', 'haversine'], help='distance metric')
+    parser.add_argument('--cache-dir', default=PIPELINE_CACHE_DIR, help='directory in which stage outputs are memoized')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of stages run at once')
+    parser.add_argument('--list', action='store_true', help='list the stages and their dependencies, then exit')
+    args = parser.parse_args(argv)
+
+    stages = build_stages(args.turnstile, args.metric, args.zip_table)
+    if args.list:
+        for stage in stages.values():
+            print(stage.name + (' <- ' + ', '.join(stage.deps) if stage.deps else ''))
+        return
+
+    pipeline = Pipeline(stages, args.cache_dir, args.workers)
+    outputs = pipeline.run(args.targets or None, args.force)
+    for name in pipeline._required(list(outputs)):
+        print('%-16s %s' % (name, 'computed' if name in pipeline.computed else 'cached'))
+    return outputs
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+'''
+Renders friction factor matrices to image files without a display, e.g. on a batch server. Figures are drawn straight
+onto an Agg canvas (pyplot and its interactive backends are never used), so rendering works in any process, and many
+matrices (one per time bucket, one per sweep configuration, ...) can be rendered in parallel worker processes. Matrices
+larger than max_size rows/columns are ordered (by line or by hierarchical clustering) and then averaged down to
+contiguous blocks, so render time and file size stay bounded however many stations there are.
+
+Run from the repository root, e.g.:
+    python render_heatmaps.py friction_factors/factor_comparison --order line
+    python render_heatmaps.py friction_factors/peak_factors --order cluster --processes 4   # one image per bucket
+'''
+import argparse
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy.cluster.hierarchy import leaves_list, linkage
+
+import matrix_store as ms
+
+# Matrices with more rows/columns than this are averaged down to this many blocks per axis
+MAX_SIZE = 150
+
+def line_order(labels, groups):
+    '''
+    Orders labels by group (e.g. station line), keeping their original order within each group.
+    Args:
+        labels: a list of labels (e.g. station names)
+        groups: a dictionary with label keys and group values (labels without a group are placed last)
+    Returns:
+        order: an integer array of positions into labels
+    '''
+    # Groups are ranked by their first appearance in groups, e.g. the order of coordinate_locations.STATION_LINES
+    rank = {}
+    for group in groups.values():
+        rank.setdefault(group, len(rank))
+    keys = [rank.get(groups.get(label), len(rank)) for label in labels]
+    return np.argsort(keys, kind='stable')
+
+def cluster_order(values, method='average', max_features=256):
+    '''
+    Orders the rows of a matrix so that rows with similar values are adjacent, by hierarchical clustering.
+    Args:
+        values: a two-dimensional numpy array (missing or infinite values are treated as 0)
+        method: the linkage method passed to scipy.cluster.hierarchy.linkage
+        max_features: rows with more values than this are averaged down to this many contiguous blocks before
+        clustering, which bounds the cost of the pairwise row distances
+    Returns:
+        order: an integer array of row positions, in the leaf order of the clustering
+    '''
+    if len(values) < 3:
+        return np.arange(len(values))
+    features = np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0)
+    if features.shape[1] > max_features:
+        starts = _block_starts(features.shape[1], max_features)
+        features = np.add.reduceat(features, starts, axis=1) / np.diff(np.append(starts, features.shape[1]))
+    return leaves_list(linkage(features, method=method))
+
+def _block_starts(n, max_size):
+    # Split n positions into at most max_size contiguous blocks of (almost) equal size
+    return np.unique(np.linspace(0, n, min(n, max_size) + 1).astype(np.intp)[:-1])
+
+def _block_labels(labels, starts, ordered):
+    # Blocks of the original order are ranges of adjacent labels ('A - B'). Once reordered, a block's members were not
+    # adjacent, so it is named by its first member and how many others it holds ('A (+11)')
+    ends = np.append(starts[1:], len(labels)) - 1
+    if ordered:
+        return [str(labels[start]) if start == end else str(labels[start]) + ' (+' + str(end - start) + ')'
+                for start, end in zip(starts, ends)]
+    return [str(labels[start]) if start == end else str(labels[start]) + ' - ' + str(labels[end])
+            for start, end in zip(starts, ends)]
+
+def reduce_matrix(frame, max_size=MAX_SIZE, order=None, groups=None):
+    '''
+    Reorders a matrix and, if it has more than max_size rows or columns, averages it down to contiguous blocks.
+    Args:
+        frame: a pandas dataframe/matrix
+        max_size: the maximum number of rows/columns of the result
+        order: None (keep the original order), 'line' (order by groups) or 'cluster' (order by hierarchical clustering)
+        groups: a dictionary with label keys and group values, used by order='line' (e.g. station lines)
+    Returns:
+        reduced: a pandas dataframe/matrix with at most max_size rows and columns, whose labels name the first and last
+        label of each block ('A - B'), or its first label and the number of other labels in it ('A (+11)') when the
+        matrix was reordered
+    '''
+    values = frame.to_numpy(dtype=np.float64)
+    rows, columns = list(frame.index), list(frame.columns)
+    # A square matrix with the same labels on both axes keeps the same order on both, so the diagonal stays a diagonal
+    square = rows == columns
+
+    if order == 'line':
+        if groups is None:
+            raise ValueError("order='line' needs groups")
+        row_order = line_order(rows, groups)
+        column_order = row_order if square else line_order(columns, groups)
+    elif order == 'cluster':
+        if square:
+            row_order = column_order = cluster_order(np.hstack([values, values.T]))
+        else:
+            row_order, column_order = cluster_order(values), cluster_order(values.T)
+    elif order is None:
+        row_order, column_order = np.arange(len(rows)), np.arange(len(columns))
+    else:
+        raise ValueError('Unknown order: ' + str(order))
+    values = values[np.ix_(row_order, column_order)]
+    rows = [rows[i] for i in row_order]
+    columns = [columns[i] for i in column_order]
+
+    if len(rows) <= max_size and len(columns) <= max_size:
+        return pd.DataFrame(values, index=rows, columns=columns)
+
+    # Average each block over its finite cells, so that missing friction factors do not drag the block towards 0
+    row_starts, column_starts = _block_starts(len(rows), max_size), _block_starts(len(columns), max_size)
+    finite = np.isfinite(values)
+    totals = np.add.reduceat(np.add.reduceat(np.where(finite, values, 0.0), row_starts, axis=0), column_starts, axis=1)
+    counts = np.add.reduceat(np.add.reduceat(finite.astype(np.float64), row_starts, axis=0), column_starts, axis=1)
+    means = np.divide(totals, counts, out=np.full_like(totals, np.nan), where=counts > 0)
+    ordered = order is not None
+    return pd.DataFrame(means, index=_block_labels(rows, row_starts, ordered),
+                        columns=_block_labels(columns, column_starts, ordered))
+
+def render_heatmap(frame, output_path, title='MBTA Station Friction Factors: Comparison', max_size=MAX_SIZE, order=None,
+                   groups=None, cmap='RdYlGn_r', dpi=100):
+    '''
+    Renders a friction factor matrix as a heatmap image file, without a display.
+    Args:
+        frame: a pandas dataframe/matrix
+        output_path: the path of the image file (the format follows its extension, e.g. .png or .svg)
+        title: the title of the heatmap
+        max_size: the maximum number of rows/columns drawn (larger matrices are averaged down, see reduce_matrix)
+        order: None, 'line' or 'cluster' (see reduce_matrix)
+        groups: a dictionary with label keys and group values, used by order='line'
+        cmap: the colour map of the heatmap
+        dpi: the resolution of the image
+    Returns:
+        output_path: the path of the image file written
+    '''
+    reduced = reduce_matrix(frame, max_size, order, groups)
+    n = max(reduced.shape)
+    # The figure grows with the matrix up to a fixed size, and per-cell gridlines are only drawn while cells are large
+    size = min(4.0 + 0.2 * n, 16.0)
+    fig = Figure(figsize=(size + 2.0, size))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    sns.heatmap(reduced, ax=ax, cmap=cmap, linewidths=0.5 if n <= 40 else 0.0, annot=False,
+                xticklabels='auto', yticklabels='auto')
+    ax.invert_yaxis() # Reverse order of y-axis for visual aid
+    if order == 'line' and reduced.shape == frame.shape and list(reduced.index) == list(reduced.columns):
+        # Mark the boundaries between lines
+        line_of = [groups.get(label) for label in reduced.index]
+        for i in range(1, len(line_of)):
+            if line_of[i] != line_of[i - 1]:
+                ax.axhline(i, color='black', linewidth=1.0)
+                ax.axvline(i, color='black', linewidth=1.0)
+    if reduced.shape != frame.shape:
+        title += ' (%d x %d, block means)' % frame.shape
+    ax.set_title(title)
+    fig.savefig(output_path, dpi=dpi, bbox_inches='tight')
+    return output_path
+
+def matrix_jobs(path, output_dir, image_format='png'):
+    '''
+    Lists the heatmaps of a matrix saved with matrix_store: one for a matrix, or one per bucket for a stations x
+    stations x buckets tensor. Only the labels are read here; each job reads its own slice of the memory map.
+    Args:
+        path: the path of the saved matrix
+        output_dir: the directory to write images to
+        image_format: the image file extension
+    Returns:
+        jobs: a list of (path, index, output_path, title) tuples, as taken by render_many
+    '''
+    matrix = ms.load_matrix(path)
+    name = os.path.basename(path[:-4] if path.endswith('.npy') else path)
+    if len(matrix.shape) == 2:
+        return [(path, (), os.path.join(output_dir, name + '.' + image_format), name)]
+    if len(matrix.shape) != 3:
+        raise ValueError('Only matrices and stations x stations x buckets tensors can be rendered: ' + path)
+    return [(path, (bucket,), os.path.join(output_dir, name + '-' + str(bucket) + '.' + image_format),
+             name + ': ' + str(bucket)) for bucket in matrix.labels[2]]
+
+def _render_job(job, **options):
+    source, index, output_path, title = job
+    # Saved matrices are opened in the worker, so only their path (not their values) is sent to the process
+    frame = ms.load_matrix(source).frame(index=index) if isinstance(source, str) else source
+    return render_heatmap(frame, output_path, title, **options)
+
+def render_many(jobs, processes=1, **options):
+    '''
+    Renders many heatmaps, optionally spread over several worker processes.
+    Args:
+        jobs: a list of (source, index, output_path, title) tuples, where source is a pandas dataframe or the path of a
+        matrix saved with matrix_store, and index selects a slice of a saved tensor (see matrix_jobs)
+        processes: the number of worker processes (1 renders every heatmap in the current process)
+        options: further keyword arguments of render_heatmap (max_size, order, groups, cmap, dpi)
+    Returns:
+        paths: a list of the image files written, in the order of jobs
+    '''
+    render = functools.partial(_render_job, **options)
+    if processes == 1 or len(jobs) <= 1:
+        return [render(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(render, jobs))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render friction factor matrices saved with matrix_store as heatmap images.')
+    parser.add_argument('matrices', nargs='+', help='paths of saved matrices (tensors render one image per bucket)')
+    parser.add_argument('--output-dir', default='./heatmaps', help='directory to write images to')
+    parser.add_argument('--format', default='png', help='image file format, e.g. png or svg')
+    parser.add_argument('--order', choices=['none', 'line', 'cluster'], default='none', help='row/column order')
+    parser.add_argument('--max-size', type=int, default=MAX_SIZE, help='maximum rows/columns drawn before averaging into blocks')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--dpi', type=int, default=100, help='image resolution')
+    args = parser.parse_args(argv)
+
+    groups = None
+    if args.order == 'line':
+        import coordinate_locations as cl
+        groups = cl.STATION_LINES
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = [job for path in args.matrices for job in matrix_jobs(path, args.output_dir, args.format)]
+    for path in render_many(jobs, args.processes, max_size=args.max_size, order=None if args.order == 'none' else args.order,
+                            groups=groups, dpi=args.dpi):
+        print(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import numpy as np
+import pandas as pd
+
+import friction_factors as ff
+import location_distances as ld
+
+class Scenario:
+    '''
+    Holds the state of the population-based gravity model in memory, so that "what if" questions about adding, moving or
+    removing a station only update the parts of the model they affect: one row/column of the distance matrix, the zip codes
+    whose nearest station changed, and the friction factor rows/columns of the stations whose popularity changed.
+    Args:
+        zip_pop: a dictionary with zip code keys and population values
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+        station_lat: a dictionary with MBTA station keys and latitude coordinate values
+        station_lon: a dictionary with MBTA station keys and longitude coordinate values
+        metric: 'euclidean' (coordinate degrees, the default) or 'haversine' (great-circle kilometres)
+    '''
+    def __init__(self, zip_pop, zip_lat, zip_lon, station_lat, station_lon, metric='euclidean'):
+        self.metric = metric
+        self.zips = list(zip_pop)
+        self.zip_pop = np.array([zip_pop[z] for z in self.zips], dtype=np.float64)
+        self.zip_lat = np.array([zip_lat[z] for z in self.zips], dtype=np.float64)
+        self.zip_lon = np.array([zip_lon[z] for z in self.zips], dtype=np.float64)
+        self.total_pop = float(self.zip_pop.sum())
+
+        # Stations occupy slots of preallocated arrays, which grow geometrically so that adding a station is amortised O(N).
+        # They start with a few spare slots only, as the distance and factor matrices are quadratic in the capacity
+        names = list(station_lat)
+        capacity = len(names) + 8
+        self.names = names + [None] * (capacity - len(names))
+        self.slots = {name: slot for slot, name in enumerate(names)}
+        self.free = list(range(capacity - 1, len(names) - 1, -1))
+        self.active = np.zeros(capacity, dtype=bool)
+        self.active[:len(names)] = True
+        self.lat = np.zeros(capacity)
+        self.lon = np.zeros(capacity)
+        self.lat[:len(names)] = [station_lat[name] for name in names]
+        self.lon[:len(names)] = [station_lon[name] for name in names]
+
+        self.distances = np.zeros((capacity, capacity))
+        n = len(names)
+        self.distances[:n, :n] = ld.pairwise_distances(self.lat[:n], self.lon[:n], self.lat[:n], self.lon[:n], metric)
+        np.fill_diagonal(self.distances, 0.0)
+
+        # Assign every zip code to its nearest station with a spatial index
+        nearest, nearest_dist = ld.nearest_stations(zip_lat, zip_lon, station_lat, station_lon, metric=metric)
+        self.nearest = np.array([self.slots[nearest[z]] for z in self.zips], dtype=np.intp)
+        self.nearest_dist = np.array([nearest_dist[z] for z in self.zips], dtype=np.float64)
+        self.popularity = np.bincount(self.nearest, weights=self.zip_pop, minlength=capacity)
+
+        self.factors = ff.gravity_kernel(self.popularity, self.popularity, self.distances, self.total_pop)
+
+    def _grow(self):
+        # Double the capacity of every per-station array, keeping existing slots in place
+        old = len(self.names)
+        new = 2 * old
+        self.names.extend([None] * (new - old))
+        self.free.extend(range(new - 1, old - 1, -1))
+        self.active = np.concatenate([self.active, np.zeros(new - old, dtype=bool)])
+        self.lat = np.concatenate([self.lat, np.zeros(new - old)])
+        self.lon = np.concatenate([self.lon, np.zeros(new - old)])
+        self.popularity = np.concatenate([self.popularity, np.zeros(new - old)])
+        for attr in ('distances', 'factors'):
+            grown = np.zeros((new, new))
+            grown[:old, :old] = getattr(self, attr)
+            setattr(self, attr, grown)
+
+    def _set_distances(self, slot):
+        # Recompute the single distance row/column of a station from its coordinates
+        row = ld.pairwise_distances(self.lat[slot:slot + 1], self.lon[slot:slot + 1], self.lat, self.lon, self.metric)[0]
+        row[~self.active] = 0.0
+        row[slot] = 0.0
+        self.distances[slot, :] = row
+        self.distances[:, slot] = row
+
+    def _reassign(self, zips):
+        # Find the nearest active station of the given zip codes, against only the currently active stations
+        if len(zips) == 0:
+            return
+        active = np.flatnonzero(self.active)
+        dist = ld.pairwise_distances(self.zip_lat[zips], self.zip_lon[zips], self.lat[active], self.lon[active], self.metric)
+        best = np.argmin(dist, axis=1)
+        self.nearest[zips] = active[best]
+        self.nearest_dist[zips] = dist[np.arange(len(zips)), best]
+
+    def _update(self, slot, orphaned):
+        '''
+        Updates catchments, popularity and friction factors after the station in slot was added, moved or removed.
+        Args:
+            slot: the slot of the changed station
+            orphaned: the zip codes (as indices) that were assigned to the station before the change
+        Returns:
+            changed: the slots whose friction factor rows/columns were recomputed
+        '''
+        previous = self.nearest.copy()
+        if self.active[slot]:
+            # Zip codes closer to the (new) station location than to their current station switch to it
+            dist = ld.pairwise_distances(self.zip_lat, self.zip_lon, self.lat[slot:slot + 1], self.lon[slot:slot + 1],
+                                         self.metric)[:, 0]
+            closer = dist < self.nearest_dist
+            closer[orphaned] = False
+            self.nearest[closer] = slot
+            self.nearest_dist[closer] = dist[closer]
+        # Zip codes of a moved or removed station are re-checked against every active station
+        self._reassign(orphaned)
+
+        # Only stations that gained or lost zip codes change popularity
+        moved = np.flatnonzero(previous != self.nearest)
+        changed = np.union1d(np.union1d(previous[moved], self.nearest[moved]), [slot]).astype(np.intp)
+        self.popularity[changed] = 0.0
+        served = np.isin(self.nearest, changed)
+        np.add.at(self.popularity, self.nearest[served], self.zip_pop[served])
+
+        # Patch the friction factor rows and columns of every changed station
+        self.factors[changed, :] = ff.gravity_kernel(self.popularity[changed], self.popularity,
+                                                     self.distances[changed, :], self.total_pop)
+        self.factors[:, changed] = ff.gravity_kernel(self.popularity, self.popularity[changed],
+                                                     self.distances[:, changed], self.total_pop)
+        return changed
+
+    def _changed_names(self, changed):
+        return [self.names[slot] for slot in changed if self.names[slot] is not None]
+
+    def add_station(self, name, lat, lon):
+        '''
+        Adds a new station, reassigning the zip codes that are now closer to it than to their current station.
+        Args:
+            name: the name of the new station
+            lat: the latitude coordinate of the new station
+            lon: the longitude coordinate of the new station
+        Returns:
+            changed: a list of the stations whose popularity and friction factors were updated
+        '''
+        if name in self.slots:
+            raise ValueError('Station already exists: ' + str(name))
+        if not self.free:
+            self._grow()
+        slot = self.free.pop()
+        self.names[slot] = name
+        self.slots[name] = slot
+        self.active[slot] = True
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+        self._set_distances(slot)
+        return self._changed_names(self._update(slot, np.array([], dtype=np.intp)))
+
+    def move_station(self, name, lat, lon):
+        '''
+        Moves an existing station, reassigning only the zip codes whose nearest station changes as a result.
+        Args:
+            name: the name of the station
+            lat: the new latitude coordinate of the station
+            lon: the new longitude coordinate of the station
+        Returns:
+            changed: a list of the stations whose popularity and friction factors were updated
+        '''
+        slot = self._slot(name)
+        orphaned = np.flatnonzero(self.nearest == slot)
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+        self._set_distances(slot)
+        return self._changed_names(self._update(slot, orphaned))
+
+    def remove_station(self, name):
+        '''
+        Removes a station, reassigning its zip codes to their next nearest station.
+        Args:
+            name: the name of the station
+        Returns:
+            changed: a list of the stations whose popularity and friction factors were updated
+        '''
+        slot = self._slot(name)
+        if self.active.sum() == 1:
+            raise ValueError('Cannot remove the last station')
+        orphaned = np.flatnonzero(self.nearest == slot)
+        self.active[slot] = False
+        self.distances[slot, :] = 0.0
+        self.distances[:, slot] = 0.0
+        changed = self._update(slot, orphaned)
+        self.names[slot] = None
+        del self.slots[name]
+        self.free.append(slot)
+        return [station for station in self._changed_names(changed) if station != name]
+
+    def _slot(self, name):
+        if name not in self.slots:
+            raise KeyError('Unknown station: ' + str(name))
+        return self.slots[name]
+
+    def popularities(self):
+        '''
+        Returns the station popularities of the current scenario, in the same form as location_distances.station_popularities.
+        Returns:
+            unique_stations: a list of the stations with a nonzero catchment population
+            station_popularity: a dictionary with station keys and catchment population values
+            total_pop: the total population of the zip code sample
+        '''
+        slots = self._popular_slots()
+        unique_stations = [self.names[slot] for slot in slots]
+        return unique_stations, dict(zip(unique_stations, self.popularity[slots].tolist())), self.total_pop
+
+    def _popular_slots(self):
+        return np.flatnonzero(self.active & (self.popularity > 0))
+
+    def station_distances(self):
+        '''
+        Returns the distances between the stations with a nonzero catchment population, as station_dist_matrix does.
+        '''
+        slots = self._popular_slots()
+        names = [self.names[slot] for slot in slots]
+        return pd.DataFrame(self.distances[np.ix_(slots, slots)], index=names, columns=names)
+
+    def estimates(self):
+        '''
+        Returns the friction factor estimates of the current scenario, in the same form as
+        friction_factors.compute_factor_estimates.
+        '''
+        slots = self._popular_slots()
+        names = [self.names[slot] for slot in slots]
+        return pd.DataFrame(self.factors[np.ix_(slots, slots)], index=names, columns=names)
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+
+import location_distances as ld
+
+def normalize_station_name(name):
+    '''
+    Normalises a station name so that names from different sources join, e.g. 'Malden Center ' and 'Malden Center'.
+    Args:
+        name: a station name
+    Returns:
+        name: the name with leading/trailing whitespace removed and inner runs of whitespace collapsed to one space
+    '''
+    return ' '.join(str(name).split())
+
+class StationRegistry:
+    '''
+    Assigns every MBTA station a dense integer ID and stores station coordinates and attributes in contiguous numpy
+    arrays indexed by that ID, so that computations can work on arrays and only convert to station names at the output.
+    Station names are normalised once, on the way in.
+    Args:
+        names: a list of station names (IDs are assigned in this order)
+        lat: an array of latitude coordinates, aligned with names
+        lon: an array of longitude coordinates, aligned with names
+        attributes: further per-station arrays aligned with names (e.g. line=[...])
+    '''
+    def __init__(self, names, lat, lon, **attributes):
+        self.names = [normalize_station_name(name) for name in names]
+        self.ids = {name: station_id for station_id, name in enumerate(self.names)}
+        if len(self.ids) != len(self.names):
+            raise ValueError('Station names are not unique after normalisation')
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.attributes = {}
+        for name, values in attributes.items():
+            self.set_attribute(name, values)
+        self._trees = {}
+
+    @classmethod
+    def from_coords(cls, coords, **attributes):
+        '''
+        Builds a registry from a dictionary of 'latitude longitude' coordinate strings, parsing each string once.
+        Args:
+            coords: a dictionary with station name keys and 'latitude longitude' string values
+            attributes: further per-station attributes, as arrays or dictionaries with station name keys
+        Returns:
+            registry: a StationRegistry
+        '''
+        parsed = np.array([value.split() for value in coords.values()], dtype=np.float64).reshape(len(coords), 2)
+        return cls(list(coords), parsed[:, 0], parsed[:, 1], **attributes)
+
+    @classmethod
+    def from_dicts(cls, station_lat, station_lon):
+        '''
+        Builds a registry from dictionaries of station latitude and longitude coordinates.
+        '''
+        names = list(station_lat)
+        return cls(names, [station_lat[name] for name in names], [station_lon[name] for name in names])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return normalize_station_name(name) in self.ids
+
+    def id(self, name):
+        '''
+        Returns the ID of a station, looked up by its normalised name.
+        '''
+        return self.ids[normalize_station_name(name)]
+
+    def lookup(self, names):
+        '''
+        Returns the IDs of several stations as an integer array, looked up by their normalised names.
+        '''
+        return np.array([self.ids[normalize_station_name(name)] for name in names], dtype=np.intp)
+
+    def labels(self, ids=None):
+        '''
+        Returns the station names of the given IDs (every station if None), for labelling output.
+        '''
+        if ids is None:
+            return list(self.names)
+        return [self.names[station_id] for station_id in ids]
+
+    def set_attribute(self, name, values):
+        '''
+        Stores a per-station attribute as an array indexed by station ID.
+        Args:
+            name: the name of the attribute
+            values: an array aligned with the station IDs, or a dictionary/series with station name keys (missing stations
+            get NaN, or None for non-numeric attributes)
+        '''
+        if isinstance(values, (dict, pd.Series)):
+            numeric = all(isinstance(value, (int, float, np.number)) for value in values.values())
+            values = self.align(values, np.nan, np.float64) if numeric else self.align(values, None, object)
+        values = np.asarray(values)
+        if values.shape[0] != len(self):
+            raise ValueError('Attribute ' + str(name) + ' does not have one value per station')
+        self.attributes[name] = values
+
+    def align(self, values, fill_value=0.0, dtype=np.float64):
+        '''
+        Converts a dictionary or pandas series keyed by station name into an array indexed by station ID. Names are
+        normalised before matching, and names that are not in the registry are ignored.
+        Args:
+            values: a dictionary or pandas series with station name keys
+            fill_value: the value for stations that are missing from values
+            dtype: the dtype of the array
+        Returns:
+            aligned: a numpy array of length len(self)
+        '''
+        aligned = np.full(len(self), fill_value, dtype=dtype)
+        for name, value in values.items():
+            station_id = self.ids.get(normalize_station_name(name))
+            if station_id is not None:
+                aligned[station_id] = value
+        return aligned
+
+    def coords(self, ids=None):
+        '''
+        Returns the latitude and longitude arrays of the given IDs (every station if None).
+        '''
+        if ids is None:
+            return self.lat, self.lon
+        return self.lat[ids], self.lon[ids]
+
+    def lat_lon_dicts(self):
+        '''
+        Returns the station coordinates as dictionaries with station name keys, as get_station_coords does.
+        '''
+        return dict(zip(self.names, self.lat.tolist())), dict(zip(self.names, self.lon.tolist()))
+
+    def tree(self, metric='euclidean'):
+        '''
+        Returns a KD-tree over the station coordinates (point i is station ID i), built once per metric.
+        '''
+        if metric not in self._trees:
+            self._trees[metric] = ld.coords_tree(self.lat, self.lon, metric)
+        return self._trees[metric]
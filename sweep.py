@@ -0,0 +1,221 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import calibration as cal
+import friction_factors as ff
+import location_distances as ld
+
+# Parameters of a sweep configuration, and the value used when a grid leaves one out
+DEFAULT_CONFIG = {'metric': 'euclidean', 'k': 1, 'decay': 'power', 'beta': 1.0}
+
+def prepare_inputs(zip_pop, zip_lat, zip_lon, station_lat, station_lon, turnstile_totals, metrics=('euclidean', 'haversine'),
+                   target_cost=None):
+    '''
+    Precomputes every input of a parameter sweep as plain numpy arrays, so that it can be shared with worker processes.
+    Args:
+        zip_pop: a dictionary with zip code keys and population values
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+        station_lat: a dictionary with MBTA station keys and latitude coordinate values
+        station_lon: a dictionary with MBTA station keys and longitude coordinate values
+        turnstile_totals: a dataframe indexed by station, with total 'entries' and 'exits' columns
+        metrics: the distance metrics the sweep may use
+        target_cost: a dictionary mapping metrics to the observed mean trip distance in that metric's units (e.g.
+        {'euclidean': 0.03, 'haversine': 3.1}), against which each configuration's modelled mean trip distance is scored
+        (metrics left out, or None, leave the cost metrics out)
+    Returns:
+        inputs: a dictionary of numpy arrays (populations, entries, exits, and station-station and zip-station distance
+        matrices for each metric), plus the 'stations' list the arrays are aligned with and the 'target_cost'
+    '''
+    # Only stations with both coordinates and turnstile data can take part in the comparison
+    stations = [station for station in station_lat if station in turnstile_totals.index]
+    zips = list(zip_pop)
+    lat = [station_lat[station] for station in stations]
+    lon = [station_lon[station] for station in stations]
+
+    inputs = {'stations': stations,
+              'target_cost': dict(target_cost or {}),
+              'population': np.array([zip_pop[z] for z in zips], dtype=np.float64),
+              'entries': turnstile_totals.loc[stations, 'entries'].to_numpy(dtype=np.float64),
+              'exits': turnstile_totals.loc[stations, 'exits'].to_numpy(dtype=np.float64)}
+    for metric in metrics:
+        inputs['station_dist_' + metric] = ld.pairwise_distances(lat, lon, lat, lon, metric)
+        np.fill_diagonal(inputs['station_dist_' + metric], 0.0)
+        inputs['zip_dist_' + metric] = ld.pairwise_distances([zip_lat[z] for z in zips], [zip_lon[z] for z in zips],
+                                                             lat, lon, metric)
+    return inputs
+
+def expand_grid(grid):
+    '''
+    Expands a parameter grid into the list of every configuration it describes.
+    Args:
+        grid: a dictionary mapping parameter names ('metric', 'k', 'decay', 'beta') to lists of values
+    Returns:
+        configs: a list of dictionaries, one per combination of values, with defaults filled in for missing parameters
+    '''
+    unknown = set(grid) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('Unknown sweep parameters: ' + ', '.join(sorted(unknown)))
+    names = list(grid)
+    return [dict(DEFAULT_CONFIG, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+def _catchment(config, inputs):
+    # Split each zip code's population evenly between its k nearest stations, and restrict the comparison to stations
+    # with a catchment, as station_popularities does
+    zip_dist = inputs['zip_dist_' + config['metric']]
+    k = min(int(config['k']), zip_dist.shape[1])
+    nearest = np.argpartition(zip_dist, k - 1, axis=1)[:, :k]
+    popularity = np.bincount(nearest.ravel(), weights=np.repeat(inputs['population'] / k, k), minlength=zip_dist.shape[1])
+    keep = popularity > 0
+    distances = inputs['station_dist_' + config['metric']][np.ix_(keep, keep)]
+    return keep, popularity[keep], inputs['entries'][keep], inputs['exits'][keep], distances
+
+def _calibration_key(config):
+    # The calibrated beta depends on the metric, k and decay of a configuration, but not on its beta
+    return config['metric'], int(config['k']), config['decay']
+
+def evaluate(config, inputs):
+    '''
+    Evaluates a single sweep configuration: assigns zip code populations to stations, computes the estimated and actual
+    friction factors, compares them, and fits a doubly-constrained gravity model to the turnstile data.
+    Args:
+        config: a dictionary with 'metric', 'k' (number of nearest stations each zip code's population is split between;
+        1 is the zip_closest_stations rule), 'decay' and 'beta' (see calibration.deterrence)
+        inputs: a dictionary of arrays from prepare_inputs
+    Returns:
+        metrics: a dictionary of fit metrics for the configuration. The log_ratio_* metrics summarise the
+        compare_factors ratios, which do not depend on decay or beta: estimates and actuals are divided by the same
+        impedance, so it cancels in the ratio. log_mass_corr correlates the distance-free parts of the two,
+        log(popularity_i * popularity_j) against log(entries_i * exits_j), which depend only on metric and k. The fit of
+        decay and beta is measured by target_cost_error, the relative error of the modelled mean trip distance against
+        the target cost of the configuration's metric (NaN without one); see also calibrate_config.
+    '''
+    keep, popularity, entries, exits, distances = _catchment(config, inputs)
+    friction = cal.deterrence(distances, config['beta'], config['decay'])
+    # The gravity kernel divides by an impedance, so pass it the reciprocal of the deterrence
+    impedance = np.divide(1.0, friction, out=np.zeros_like(friction), where=friction > 0)
+
+    estimates = ff.gravity_kernel(popularity, popularity, impedance, popularity.sum())
+    actuals = ff.gravity_kernel(entries, exits, impedance, exits.sum())
+    valid = (estimates > 0) & (actuals > 0)
+    log_ratio = np.log(actuals[valid] / estimates[valid])
+
+    # Correlate the distance-free parts of the estimates and actuals; correlating the factors themselves would mostly
+    # measure the shared impedance term, and rise with beta whatever the data
+    estimated_mass = np.outer(popularity, popularity)
+    actual_mass = np.outer(entries, exits)
+    off_diagonal = ~np.eye(len(popularity), dtype=bool)
+    positive = off_diagonal & (estimated_mass > 0) & (actual_mass > 0)
+    mass_corr = (float(np.corrcoef(np.log(estimated_mass[positive]), np.log(actual_mass[positive]))[0, 1])
+                 if positive.sum() > 1 else np.nan)
+
+    trips, _, _, iterations, converged = cal.furness(entries, exits, friction)
+    model_cost = cal.mean_trip_cost(trips, distances)
+
+    # Score decay and beta against the observed mean trip distance in the units of the configuration's metric
+    target_cost = inputs['target_cost'].get(config['metric'])
+    cost_error = abs(model_cost - target_cost) / target_cost if target_cost else np.nan
+
+    return {'n_stations': int(keep.sum()),
+            'n_pairs': int(valid.sum()),
+            'log_ratio_mean': float(log_ratio.mean()) if log_ratio.size else np.nan,
+            'log_ratio_std': float(log_ratio.std()) if log_ratio.size else np.nan,
+            'log_ratio_rmse': float(np.sqrt(np.mean(log_ratio ** 2))) if log_ratio.size else np.nan,
+            'log_mass_corr': mass_corr,
+            'model_mean_cost': model_cost,
+            'target_cost_error': cost_error,
+            'furness_iterations': iterations,
+            'furness_converged': converged}
+
+def calibrate_config(config, inputs):
+    '''
+    Fits beta for a sweep configuration's metric, k and decay with calibration.calibrate, so that the modelled mean trip
+    distance matches the target cost of the metric. The configuration's own beta is not used: calibration always starts
+    from calibrate's default, so every configuration with the same metric, k and decay gets the same result.
+    Args:
+        config: a dictionary with 'metric', 'k' and 'decay' (see evaluate)
+        inputs: a dictionary of arrays from prepare_inputs
+    Returns:
+        metrics: a dictionary with calibrated_beta (NaN if calibration did not converge, or without a target cost) and
+        calibration_converged
+    '''
+    target_cost = inputs['target_cost'].get(config['metric'])
+    if not target_cost:
+        return {'calibrated_beta': np.nan, 'calibration_converged': False}
+    _, _, entries, exits, distances = _catchment(config, inputs)
+    beta, _, _, _, converged = cal.calibrate(entries, exits, distances, target_cost, decay=config['decay'])
+    return {'calibrated_beta': beta if converged else np.nan, 'calibration_converged': converged}
+
+# Arrays shared with a worker process, attached once per worker by _attach_shared
+_shared_inputs = {}
+_shared_blocks = []
+
+def _attach_shared(specs, extras):
+    # Map every shared memory block into this worker without copying it
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_blocks.append(block)
+        _shared_inputs[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _shared_inputs.update(extras)
+
+def _evaluate_shared(config):
+    return evaluate(config, _shared_inputs)
+
+def _calibrate_shared(config):
+    return calibrate_config(config, _shared_inputs)
+
+def run_sweep(grid, inputs, processes=None, chunksize=None):
+    '''
+    Evaluates every configuration of a parameter grid, fanning the evaluations out across a process pool. The input arrays
+    are placed in shared memory once and mapped by every worker, so only the small configuration dictionaries are pickled
+    per task. Calibration (see calibrate_config) runs once per combination of metric, k and decay, not once per beta.
+    Args:
+        grid: a dictionary mapping parameter names ('metric', 'k', 'decay', 'beta') to lists of values
+        inputs: a dictionary of arrays from prepare_inputs
+        processes: the number of worker processes (all cores if None; 1 runs in the current process)
+        chunksize: the number of configurations handed to a worker at a time (chosen automatically if None)
+    Returns:
+        results: a tidy pandas dataframe with one row per configuration, holding its parameters and fit metrics
+    '''
+    configs = expand_grid(grid)
+    processes = processes or os.cpu_count() or 1
+    # One representative configuration per calibration, in the order they first appear
+    calibrations = {}
+    for config in configs:
+        calibrations.setdefault(_calibration_key(config), config)
+
+    if processes == 1 or len(configs) == 1:
+        calibrated = [calibrate_config(config, inputs) for config in calibrations.values()]
+        metrics = [evaluate(config, inputs) for config in configs]
+    else:
+        arrays = {name: value for name, value in inputs.items() if isinstance(value, np.ndarray)}
+        extras = {name: value for name, value in inputs.items() if name not in arrays}
+        blocks = []
+        try:
+            specs = {}
+            for name, array in arrays.items():
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+                specs[name] = (block.name, array.shape, array.dtype.str)
+            if chunksize is None:
+                chunksize = max(1, len(configs) // (processes * 4))
+            with ProcessPoolExecutor(max_workers=processes, initializer=_attach_shared, initargs=(specs, extras)) as executor:
+                # Calibrations are the slowest tasks, so they are queued first
+                calibrated = executor.map(_calibrate_shared, calibrations.values())
+                metrics = list(executor.map(_evaluate_shared, configs, chunksize=chunksize))
+                calibrated = list(calibrated)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    calibrated = dict(zip(calibrations, calibrated))
+    empty = {'calibrated_beta': np.nan, 'calibration_converged': False}
+    calibrated = [calibrated.get(_calibration_key(config), empty) for config in configs]
+    return pd.concat([pd.DataFrame(configs), pd.DataFrame(metrics), pd.DataFrame(calibrated)], axis=1)
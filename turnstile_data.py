@@ -0,0 +1,272 @@
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from station_registry import normalize_station_name
+
+# Location of the raw turnstile data
+# Data from https://github.com/mbtaviz/mbtaviz.github.io/
+TURNSTILE_PATH = './data/turnstile_data.csv'
+# Directory holding one or more turnstile data files; files added here are picked up incrementally
+TURNSTILE_DIR = './data'
+TURNSTILE_PATTERN = 'turnstile*.csv'
+
+# Directory in which aggregated turnstile tables are cached
+TURNSTILE_CACHE_DIR = './.cache/turnstile'
+# Version of the cached aggregates, part of every cache key and file name. Bump it whenever the output of
+# _stream_aggregate or the layout of the cache changes (e.g. version 2 normalises station names, version 3 drops rows
+# without a station, version 4 names tables by file), so tables written by older code are not reused
+TURNSTILE_CACHE_VERSION = 4
+
+# Only these columns of the turnstile data are needed to compute friction factors, read with compact dtypes
+TURNSTILE_DTYPES = {'station': 'category', 'entries': 'int32', 'exits': 'int32'}
+# Column holding the timestamp of each turnstile observation
+TIME_COLUMN = 'time'
+
+def _peak_period(times):
+    # Weekday AM peak (7-10am) and PM peak (4-7pm); everything else, including weekends, is off-peak
+    hour = times.dt.hour
+    weekday = times.dt.dayofweek < 5
+    period = np.where(weekday & (hour >= 7) & (hour < 10), 'am_peak',
+                      np.where(weekday & (hour >= 16) & (hour < 19), 'pm_peak', 'off_peak'))
+    return pd.Series(period, index=times.index)
+
+def _by_day(label):
+    # Calendar buckets only depend on the date, so label each distinct day once rather than every observation
+    def bucket(times):
+        codes, days = pd.factorize(times.dt.normalize())
+        return pd.Series(np.asarray(label(pd.Series(days)), dtype=str)[codes], index=times.index)
+    return bucket
+
+# Built-in time buckets, each mapping a series of timestamps to a series of bucket labels
+TIME_BUCKETS = {'hour': lambda times: times.dt.hour,
+                'weekday': lambda times: times.dt.dayofweek,
+                'daytype': lambda times: pd.Series(np.where(times.dt.dayofweek < 5, 'weekday', 'weekend'), index=times.index),
+                'peak': _peak_period,
+                'day': _by_day(lambda days: days.dt.strftime('%Y-%m-%d')),
+                'week': _by_day(lambda days: days.dt.to_period('W').astype(str)),
+                'month': _by_day(lambda days: days.dt.strftime('%Y-%m'))}
+
+def _resolve_bucket(bucket):
+    '''
+    Looks up a built-in time bucket by name, or passes a custom bucket function through unchanged.
+    '''
+    if callable(bucket):
+        return bucket
+    if bucket not in TIME_BUCKETS:
+        raise ValueError('Unknown time bucket: ' + str(bucket) + '. Expected one of ' + ', '.join(TIME_BUCKETS))
+    return TIME_BUCKETS[bucket]
+
+def _stream_aggregate(path, stations, chunksize, bucket=None, time_column=TIME_COLUMN):
+    '''
+    Streams a turnstile data file in chunks and sums entries and exits by station (and optionally by time bucket).
+    '''
+    if stations is not None:
+        stations = set(normalize_station_name(station) for station in stations)
+    keys = ['station']
+    usecols = list(TURNSTILE_DTYPES)
+    if bucket is not None:
+        bucket = _resolve_bucket(bucket)
+        keys.append('bucket')
+        usecols.append(time_column)
+
+    totals = None
+    reader = pd.read_csv(path, usecols=usecols, dtype=TURNSTILE_DTYPES, chunksize=chunksize)
+    for chunk in reader:
+        # Normalise station names once per distinct name rather than once per row, so that e.g. 'Wellington ' and
+        # 'Wellington' join; category codes also differ from chunk to chunk, so accumulate on plain station names
+        names = np.array([normalize_station_name(name) for name in chunk.station.cat.categories], dtype=object)
+        codes = chunk.station.cat.codes.to_numpy()
+        # Rows without a station have code -1, which would otherwise pick the last name; drop them, and any name that is
+        # only whitespace, as a groupby on the raw column would
+        named = codes >= 0
+        named[named] = names[codes[named]] != ''
+        chunk = chunk[named].assign(station=names[codes[named]])
+        # Push the station filter into the read loop, so unwanted rows are dropped before they are aggregated
+        if stations is not None:
+            chunk = chunk[chunk.station.isin(stations)]
+        if bucket is not None:
+            chunk = chunk.assign(bucket=bucket(pd.to_datetime(chunk[time_column])))
+        sums = chunk.groupby(keys)[['entries', 'exits']].sum()
+        totals = sums if totals is None else totals.add(sums, fill_value=0)
+
+    if totals is None:
+        totals = pd.DataFrame(columns=['entries', 'exits'], index=pd.MultiIndex.from_arrays([[]] * len(keys), names=keys))
+        if bucket is None:
+            totals.index = pd.Index([], name='station')
+    return totals.astype(np.int64).sort_index()
+
+def read_turnstile_totals(path=TURNSTILE_PATH, stations=None, chunksize=500000):
+    '''
+    Streams the raw turnstile data in chunks and accumulates the total entries and exits of each station, so that memory
+    use stays flat no matter how large the file is.
+    Args:
+        path: the path of a turnstile data CSV file (or an open file object)
+        stations: an array of the MBTA stations to keep (all stations are kept if None)
+        chunksize: the number of CSV rows to read at a time
+    Returns:
+        totals: a pandas dataframe indexed by station, with int64 'entries' and 'exits' columns, in the same form as the
+        output of friction_factors.consolidate_turnstile_data
+    '''
+    return _stream_aggregate(path, stations, chunksize)
+
+def read_turnstile_buckets(path=TURNSTILE_PATH, bucket='peak', stations=None, chunksize=500000, time_column=TIME_COLUMN):
+    '''
+    Streams the raw turnstile data in chunks and accumulates the total entries and exits of each station in each time
+    bucket, in a single pass over the file.
+    Args:
+        path: the path of a turnstile data CSV file (or an open file object)
+        bucket: the name of a time bucket in TIME_BUCKETS ('hour', 'weekday', 'daytype', 'peak', 'day', 'week' or
+        'month'), or a function mapping a series of timestamps to a series of bucket labels
+        stations: an array of the MBTA stations to keep (all stations are kept if None)
+        chunksize: the number of CSV rows to read at a time
+        time_column: the name of the column holding the timestamp of each observation
+    Returns:
+        totals: a pandas dataframe indexed by (station, bucket), with int64 'entries' and 'exits' columns
+    '''
+    return _stream_aggregate(path, stations, chunksize, bucket, time_column)
+
+def _turnstile_files(paths, pattern=TURNSTILE_PATTERN):
+    '''
+    Expands a file, a directory or a list of files/directories into a sorted list of turnstile data files.
+    '''
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            files.append(path)
+    return files
+
+def _file_fingerprint(path, content_hash=False):
+    '''
+    Identifies the current contents of a file by its size and modification time, and optionally a hash of its bytes.
+    '''
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if content_hash:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        fingerprint['sha1'] = sha.hexdigest()
+    return fingerprint
+
+def _cache_key(fingerprint, stations, **options):
+    '''
+    Builds the cache key of one turnstile file's aggregate from its fingerprint, the station set, the cache version and any
+    other options.
+    '''
+    key = dict(fingerprint, stations=None if stations is None else sorted(stations), version=TURNSTILE_CACHE_VERSION,
+               **options)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _cache_slot(path, stations, **options):
+    '''
+    Identifies the cached table of one turnstile file and set of options, whatever the file's current contents, so that a
+    table written for new contents can replace the table of the old ones.
+    '''
+    return _cache_key({'path': os.path.abspath(path)}, stations, **options)[:16]
+
+def _save_table(path, table):
+    '''
+    Saves an aggregated turnstile table as a set of columnar numpy arrays in an .npz file.
+    '''
+    table = table.reset_index()
+    columns = {name: table[name].to_numpy() for name in table.columns}
+    # Store labels as fixed-width strings, so the cache can be loaded without unpickling
+    for name in columns:
+        if columns[name].dtype == object:
+            columns[name] = columns[name].astype(str)
+    # Write to a temporary file first so that an interrupted run never leaves a corrupt cache entry
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp.npz'
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+def _load_table(path):
+    '''
+    Loads an aggregated turnstile table saved by _save_table.
+    '''
+    with np.load(path, allow_pickle=False) as columns:
+        table = pd.DataFrame({name: columns[name] for name in columns.files})
+    keys = ['station', 'bucket'] if 'bucket' in table.columns else ['station']
+    return table.set_index(keys)
+
+def _cache_prefix():
+    return 'totals-v' + str(TURNSTILE_CACHE_VERSION) + '-'
+
+def _prune_cache(cache_dir, slot=None, keep=None):
+    '''
+    Removes cached tables that can never be read again: those written by other versions of the aggregation or, given a
+    slot, the tables of that file and set of options other than keep (written for contents the file no longer has).
+    '''
+    if slot is None:
+        stale = [path for path in glob.glob(os.path.join(cache_dir, 'totals-*.npz'))
+                 if not os.path.basename(path).startswith(_cache_prefix())]
+    else:
+        stale = [path for path in glob.glob(os.path.join(cache_dir, _cache_prefix() + slot + '-*.npz')) if path != keep]
+    for path in stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError: # Already removed by a concurrent run
+            pass
+
+def cached_turnstile_totals(paths=TURNSTILE_DIR, stations=None, bucket=None, cache_dir=TURNSTILE_CACHE_DIR,
+                            content_hash=False, chunksize=500000, time_column=TIME_COLUMN):
+    '''
+    Computes the total entries and exits of each station over one or more turnstile data files, caching the aggregate of
+    each file on disk. A file is only re-read when its size or modification time (or, optionally, contents) change, so a
+    warm start reads nothing but the small cached tables, and adding a new file to the data directory only reads that file.
+    Args:
+        paths: a turnstile data file, a directory of turnstile data files, or a list of either
+        stations: an array of the MBTA stations to keep (all stations are kept if None)
+        bucket: the name of a time bucket in TIME_BUCKETS to also aggregate by (None aggregates over all time)
+        cache_dir: the directory in which the aggregated tables are cached
+        content_hash: whether to also hash each file's contents when checking whether it changed
+        chunksize: the number of CSV rows to read at a time when a file is not cached
+        time_column: the name of the column holding the timestamp of each observation
+    Returns:
+        totals: a pandas dataframe indexed by station (or by (station, bucket) when bucket is given), with int64 'entries'
+        and 'exits' columns
+    '''
+    if bucket is not None and not isinstance(bucket, str):
+        raise ValueError('Only named time buckets can be cached; use read_turnstile_buckets for a custom bucket function')
+    os.makedirs(cache_dir, exist_ok=True)
+    _prune_cache(cache_dir)
+
+    tables = []
+    for path in _turnstile_files(paths):
+        key = _cache_key(_file_fingerprint(path, content_hash), stations, bucket=bucket, time_column=time_column)
+        slot = _cache_slot(path, stations, bucket=bucket, time_column=time_column)
+        cache_path = os.path.join(cache_dir, _cache_prefix() + slot + '-' + key + '.npz')
+        if os.path.exists(cache_path):
+            table = _load_table(cache_path)
+        else:
+            table = _stream_aggregate(path, stations, chunksize, bucket, time_column)
+            _save_table(cache_path, table)
+            # The file changed since any older table of it was written, so that table can go
+            _prune_cache(cache_dir, slot, cache_path)
+        tables.append(table)
+
+    if not tables:
+        raise FileNotFoundError('No turnstile data files found in ' + str(paths))
+    # Combine the per-file aggregates into one total per station (and bucket)
+    combined = pd.concat(tables)
+    return combined.groupby(level=list(combined.index.names)).sum().astype(np.int64)
+
+def station_arrays(turnstile_totals, registry):
+    '''
+    Converts aggregated turnstile totals into entries and exits arrays indexed by station ID.
+    Args:
+        turnstile_totals: a dataframe indexed by station, with total 'entries' and 'exits' columns
+        registry: a station_registry.StationRegistry
+    Returns:
+        entries: a float64 array of total entries indexed by station ID (zero for stations without turnstile data)
+        exits: a float64 array of total exits indexed by station ID (zero for stations without turnstile data)
+    '''
+    return registry.align(turnstile_totals['entries']), registry.align(turnstile_totals['exits'])
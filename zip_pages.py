@@ -0,0 +1,257 @@
+'''
+Extracts population, latitude and longitude from saved zip-codes.com zip code pages, and ingests whole directories or
+archives (.zip, .tar, .tar.gz) of saved pages into a compact zip code attribute table that
+coordinate_locations.get_zip_coords can load instead of scraping.
+
+Pages are parsed in a single pass with the standard library's event-driven HTML parser, which stops as soon as every
+field has been found, and values are found by the label of their table row (e.g. 'Latitude:') rather than by the
+row's position, which differs between pages. Files are spread across a process pool.
+
+Run from the repository root, e.g.:
+    python zip_pages.py saved_pages/ --output data/zip_attributes.csv
+    python zip_pages.py saved_pages.tar.gz --processes 8
+'''
+import argparse
+import os
+import re
+import sys
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+
+import pandas as pd
+
+# Default location of the zip code attribute table written by ingest_zip_pages
+ZIP_TABLE_PATH = './data/zip_attributes.csv'
+
+# Row labels (lower case, without the trailing colon) of the values extracted from a zip code page, and their fields
+ZIP_PAGE_FIELDS = {'latitude': 'lat',
+                   'longitude': 'lon',
+                   'current population': 'population',
+                   'population': 'population'}
+
+# File extensions of saved pages, and the zip code in a page's file name (e.g. zip-code-02108.asp)
+PAGE_EXTENSIONS = ('.asp', '.htm', '.html')
+ZIP_IN_NAME = re.compile(r'(\d{5})(?!.*\d{5})')
+
+class _Found(Exception):
+    # Raised to stop parsing once every field has been found
+    pass
+
+class _RowLabelParser(HTMLParser):
+    '''
+    Collects the text of the cells of every table row, and records the second cell of each row whose first cell is one
+    of the labels in ZIP_PAGE_FIELDS. Row and cell state is kept on a stack with one entry per open <table>, so a table
+    nested inside a cell does not disturb the row around it, and a row left open by a missing </tr> is closed (rather than
+    dropped) when the next row starts.
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.values = {}
+        # Each entry is [cells of the open row or None, text of the open cell or None]; the first covers rows outside
+        # of any <table>
+        self._stack = [[None, None]]
+        self._fields = set(ZIP_PAGE_FIELDS.values())
+
+    def handle_starttag(self, tag, attrs):
+        state = self._stack[-1]
+        if tag == 'table':
+            self._stack.append([None, None])
+        elif tag == 'tr':
+            self._end_row(state)
+            state[0] = []
+        elif tag in ('td', 'th'):
+            self._end_cell(state)
+            if state[0] is None:
+                # A cell outside of a row starts one, as browsers do
+                state[0] = []
+            state[1] = []
+
+    def handle_endtag(self, tag):
+        state = self._stack[-1]
+        if tag == 'table':
+            self._end_row(state)
+            if len(self._stack) > 1:
+                self._stack.pop()
+        elif tag == 'tr':
+            self._end_row(state)
+        elif tag in ('td', 'th'):
+            self._end_cell(state)
+
+    def handle_data(self, data):
+        text = self._stack[-1][1]
+        if text is not None:
+            text.append(data)
+
+    def close(self):
+        super().close()
+        # Close any rows still open at the end of the page, innermost first
+        while self._stack:
+            self._end_row(self._stack.pop())
+
+    def _end_cell(self, state):
+        if state[1] is not None:
+            state[0].append(' '.join(''.join(state[1]).split()))
+            state[1] = None
+
+    def _end_row(self, state):
+        self._end_cell(state)
+        cells, state[0] = state[0], None
+        if cells is None or len(cells) < 2:
+            return
+        field = ZIP_PAGE_FIELDS.get(cells[0].rstrip(':').strip().lower())
+        # The first row with a given label wins, e.g. the current population rather than a historical one
+        if field is not None and field not in self.values:
+            self.values[field] = cells[1]
+            if self._fields.issubset(self.values):
+                raise _Found()
+
+def _to_number(text, kind):
+    # Strip thousands separators and any trailing text (e.g. '42.3503 N'), returning None if there is no number
+    match = re.search(r'-?[\d,]*\.?\d+', text)
+    if match is None:
+        return None
+    return kind(match.group(0).replace(',', ''))
+
+def parse_zip_page(content):
+    '''
+    Extracts the population, latitude and longitude of a zip code from its zip-codes.com page, in a single pass.
+    Args:
+        content: the page as bytes or a string
+    Returns:
+        values: a dictionary with 'population', 'lat' and 'lon' keys (fields missing from the page are None)
+    '''
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+    parser = _RowLabelParser()
+    try:
+        parser.feed(content)
+        parser.close()
+    except _Found:
+        pass
+    return {'population': _to_number(parser.values['population'], int) if 'population' in parser.values else None,
+            'lat': _to_number(parser.values['lat'], float) if 'lat' in parser.values else None,
+            'lon': _to_number(parser.values['lon'], float) if 'lon' in parser.values else None}
+
+def _zip_from_name(name):
+    match = ZIP_IN_NAME.search(os.path.basename(name))
+    return match.group(1) if match else None
+
+def _is_page(name):
+    return name.lower().endswith(PAGE_EXTENSIONS) and _zip_from_name(name) is not None
+
+def _iter_pages(source):
+    '''
+    Yields the saved zip code pages of a directory or archive, as (name, path) for files in a directory (read by the
+    worker) and (name, bytes) for archive members (read here, as archives are read sequentially).
+    '''
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if _is_page(name):
+                    yield name, os.path.join(root, name)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_page(info.filename):
+                    yield info.filename, archive.read(info)
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            for member in archive:
+                if member.isfile() and _is_page(member.name):
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError('Not a directory or a zip/tar archive: ' + str(source))
+
+def _parse_batch(batch):
+    # Parse a batch of pages in a worker process, reading pages given as paths from disk
+    records = []
+    for name, page in batch:
+        if isinstance(page, str):
+            with open(page, 'rb') as f:
+                page = f.read()
+        records.append(dict(parse_zip_page(page), zip=_zip_from_name(name)))
+    return records
+
+def _batches(pages, batch_size):
+    batch = []
+    for page in pages:
+        batch.append(page)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ingest_zip_pages(source, output_path=ZIP_TABLE_PATH, processes=None, batch_size=256):
+    '''
+    Parses every saved zip code page in a directory or archive into a zip code attribute table, and writes it to CSV.
+    The zip code of a page is taken from its file name (e.g. zip-code-02108.asp).
+    Args:
+        source: a directory (searched recursively) or a .zip/.tar/.tar.gz archive of saved zip code pages
+        output_path: the CSV file to write the table to (compressed if it ends in e.g. .gz; nothing is written if None)
+        processes: the number of worker processes (all cores if None; 1 parses every page in the current process)
+        batch_size: the number of pages handed to a worker at a time
+    Returns:
+        table: a pandas dataframe with one row per zip code and 'zip', 'population', 'lat' and 'lon' columns
+    '''
+    processes = processes or os.cpu_count() or 1
+    batches = _batches(_iter_pages(source), batch_size)
+    records = []
+    if processes == 1:
+        for batch in batches:
+            records.extend(_parse_batch(batch))
+    else:
+        # Keep a bounded number of batches in flight, so that archive members are not all read into memory at once
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(_parse_batch, batch))
+                if len(pending) >= 2 * processes:
+                    records.extend(pending.popleft().result())
+            while pending:
+                records.extend(pending.popleft().result())
+
+    table = pd.DataFrame(records, columns=['zip', 'population', 'lat', 'lon'])
+    table['population'] = table['population'].astype('Int64')
+    # Pages saved more than once (e.g. under two names) keep their first copy
+    table = table.drop_duplicates('zip').sort_values('zip', ignore_index=True)
+    incomplete = table[['lat', 'lon']].isna().any(axis=1)
+    if incomplete.any():
+        print('Warning: no coordinates found for zip codes ' + ', '.join(table.loc[incomplete, 'zip']), file=sys.stderr)
+    if output_path is not None:
+        table.to_csv(output_path, index=False)
+    return table
+
+def load_zip_table(path=ZIP_TABLE_PATH):
+    '''
+    Loads a zip code attribute table written by ingest_zip_pages, in the form returned by
+    coordinate_locations.get_zip_coords. As there, zip codes without population (or without coordinates) are left out.
+    Args:
+        path: the path of the table
+    Returns:
+        zip_pop: a dictionary with zip code keys and population values
+        zip_lat: a dictionary with zip code keys and latitude coordinate values
+        zip_lon: a dictionary with zip code keys and longitude coordinate values
+    '''
+    # Zip codes are read as strings, so that leading zeros (e.g. 02108) are kept
+    table = pd.read_csv(path, dtype={'zip': str, 'population': 'Int64', 'lat': 'float64', 'lon': 'float64'})
+    table = table[(table['population'].fillna(0) > 0) & table['lat'].notna() & table['lon'].notna()]
+    return (dict(zip(table['zip'], table['population'].astype(int).tolist())),
+            dict(zip(table['zip'], table['lat'].tolist())),
+            dict(zip(table['zip'], table['lon'].tolist())))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ingest saved zip-codes.com zip code pages into a zip code attribute table.')
+    parser.add_argument('source', help='directory or .zip/.tar/.tar.gz archive of saved zip code pages')
+    parser.add_argument('--output', default=ZIP_TABLE_PATH, help='CSV file to write the table to')
+    parser.add_argument('--processes', type=int, help='number of worker processes (default: all cores)')
+    parser.add_argument('--batch-size', type=int, default=256, help='number of pages handed to a worker at a time')
+    args = parser.parse_args(argv)
+    table = ingest_zip_pages(args.source, args.output, args.processes, args.batch_size)
+    print('Wrote ' + str(len(table)) + ' zip codes to ' + args.output)
+
+if __name__ == '__main__':
+    main()